@@ -0,0 +1,372 @@
+import asyncio
+import re
+from collections import Counter
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from typing import Any
+
+from aiohttp import web
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+song_regex = re.compile(r"Song (\d+)")
+
+
+@dataclass
+class Catalog:
+    # Synthetic tracks, every name and id derives from the track's index
+    size: int
+    album_size: int = 12
+    artists: int = 997
+
+    def track_id(self, index: int) -> str:
+        return f"t{index:021d}"
+
+    def album_id(self, album: int) -> str:
+        return f"a{album:021d}"
+
+    def index(self, value: str) -> int | None:
+        # Track ids, uris and search terms all lead back to the index
+        if match := re.search(r"t(\d{21})$", value):
+            index = int(match.group(1))
+        elif match := song_regex.search(value):
+            index = int(match.group(1))
+        else:
+            return None
+
+        return index if index < self.size else None
+
+    def artist(self, index: int) -> dict[str, Any]:
+        artist = index % self.artists
+        return {
+            "id": f"r{artist:021d}",
+            "name": f"Artist {artist}",
+            "uri": f"spotify:artist:r{artist:021d}",
+        }
+
+    def album(self, album: int, tracks: bool = True) -> dict[str, Any]:
+        first = album * self.album_size
+        count = min(self.album_size, self.size - first)
+
+        response: dict[str, Any] = {
+            "id": self.album_id(album),
+            "name": f"Album {album}",
+            "uri": f"spotify:album:{self.album_id(album)}",
+            "artists": [self.artist(first)],
+            "total_tracks": count,
+            "images": [{"url": "https://i.invalid/cover", "height": 640}],
+        }
+
+        if tracks:
+            response["tracks"] = self.album_tracks(album, 0, 50)
+
+        return response
+
+    def album_tracks(self, album: int, offset: int, limit: int) -> dict[str, Any]:
+        first = album * self.album_size
+        count = min(self.album_size, self.size - first)
+        indexes = range(first + offset, first + min(count, offset + limit))
+
+        return {
+            "items": [self.track(index, album=False) for index in indexes],
+            "offset": offset,
+            "limit": limit,
+            "total": count,
+        }
+
+    def track(self, index: int, album: bool = True) -> dict[str, Any]:
+        track: dict[str, Any] = {
+            "id": self.track_id(index),
+            "name": f"Song {index}",
+            "uri": f"spotify:track:{self.track_id(index)}",
+            "artists": [self.artist(index)],
+            "external_ids": {"isrc": f"BENCH{index:07d}"},
+            "duration_ms": 180_000 + index % 60_000,
+            "is_local": False,
+            "available_markets": ["EE", "FI", "LV", "LT", "SE", "NO", "DK"],
+        }
+
+        if album:
+            track["album"] = self.album(index // self.album_size, tracks=False)
+
+        return track
+
+    def deezer_track(self, index: int) -> dict[str, Any]:
+        return {
+            "SNG_ID": str(100_000 + index),
+            "SNG_TITLE": f"Song {index}",
+            "ARTISTS": [{"ART_NAME": self.artist(index)["name"]}],
+            "FILESIZE_FLAC": "31457280",
+            "FILESIZE_MP3_320": "7340032",
+            "FILESIZE_MP3_128": "2936012",
+            "MD5_ORIGIN": "0" * 32,
+            "TRACK_TOKEN": "x" * 180,
+        }
+
+
+@dataclass
+class Faults:
+    # Seconds added to every request, and every nth Spotify request answers 429
+    latency: float = 0.0
+    rate_limit_every: int = 0
+    retry_after: float = 1.0
+
+
+@dataclass
+class Playlist:
+    name: str
+    uris: list[str]
+    snapshot: int = 0
+
+
+@dataclass
+class FakeSpotify:
+    catalog: Catalog
+    faults: Faults
+    requests: Counter[str] = field(default_factory=Counter)
+    playlists: dict[str, Playlist] = field(default_factory=dict)
+    _sent: int = 0
+
+    def reset(self, catalog: Catalog) -> None:
+        self.catalog = catalog
+        self.requests.clear()
+        self.playlists = {
+            "bench": Playlist(
+                "Bench",
+                [f"spotify:track:{catalog.track_id(i)}" for i in range(catalog.size)],
+            )
+        }
+
+    @web.middleware
+    async def middleware(self, request: web.Request, handler: Handler) -> Any:
+        route = request.match_info.route.resource
+        name = route.canonical if route is not None else request.path
+        self.requests[f"{request.method} {name}"] += 1
+        self._sent += 1
+
+        await asyncio.sleep(self.faults.latency)
+
+        if (every := self.faults.rate_limit_every) and self._sent % every == 0:
+            return web.Response(
+                status=429, headers={"Retry-After": str(self.faults.retry_after)}
+            )
+
+        return await handler(request)
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_post("/api/token", self.token)
+        app.router.add_get("/v1/playlists/{id}", self.playlist)
+        app.router.add_get("/v1/playlists/{id}/items", self.playlist_items)
+        app.router.add_post("/v1/playlists/{id}/items", self.add_items)
+        app.router.add_put("/v1/playlists/{id}/items", self.update_items)
+        app.router.add_get("/v1/me/playlists", self.user_playlists)
+        app.router.add_post("/v1/me/playlists", self.create_playlist)
+        app.router.add_get("/v1/search", self.search)
+        app.router.add_get("/v1/albums", self.albums)
+        app.router.add_get("/v1/albums/{id}", self.album)
+        app.router.add_get("/v1/albums/{id}/tracks", self.album_tracks)
+        return app
+
+    def _playlist(self, request: web.Request) -> Playlist:
+        if (playlist := self.playlists.get(request.match_info["id"])) is None:
+            raise web.HTTPNotFound(text="playlist not found")
+        return playlist
+
+    def _snapshot(self, playlist: Playlist) -> web.Response:
+        playlist.snapshot += 1
+        return web.json_response({"snapshot_id": f"s{playlist.snapshot}"})
+
+    async def token(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {"access_token": "app-token", "token_type": "Bearer", "expires_in": 3600}
+        )
+
+    async def playlist(self, request: web.Request) -> web.Response:
+        playlist = self._playlist(request)
+        return web.json_response(
+            {
+                "id": request.match_info["id"],
+                "name": playlist.name,
+                "owner": {"display_name": "bench"},
+                "snapshot_id": f"s{playlist.snapshot}",
+                "items": {"total": len(playlist.uris)},
+            }
+        )
+
+    async def playlist_items(self, request: web.Request) -> web.Response:
+        playlist = self._playlist(request)
+        offset = int(request.query.get("offset", 0))
+        limit = int(request.query.get("limit", 50))
+
+        items: list[dict[str, Any]] = []
+        for uri in playlist.uris[offset : offset + limit]:
+            index = self.catalog.index(uri)
+            items.append({"item": None if index is None else self.catalog.track(index)})
+
+        return web.json_response(
+            {
+                "items": items,
+                "offset": offset,
+                "limit": limit,
+                "total": len(playlist.uris),
+            }
+        )
+
+    async def add_items(self, request: web.Request) -> web.Response:
+        playlist = self._playlist(request)
+        body: dict[str, Any] = await request.json()
+
+        position = body.get("position", len(playlist.uris))
+        playlist.uris[position:position] = body["uris"]
+        return self._snapshot(playlist)
+
+    async def update_items(self, request: web.Request) -> web.Response:
+        playlist = self._playlist(request)
+        body: dict[str, Any] = await request.json()
+
+        if "uris" in body:
+            playlist.uris = list(body["uris"])
+            return self._snapshot(playlist)
+
+        start = body["range_start"]
+        length = body.get("range_length", 1)
+        before = body["insert_before"]
+
+        moved = playlist.uris[start : start + length]
+        del playlist.uris[start : start + length]
+        if before > start:
+            before -= length
+        playlist.uris[before:before] = moved
+        return self._snapshot(playlist)
+
+    async def user_playlists(self, request: web.Request) -> web.Response:
+        offset = int(request.query.get("offset", 0))
+        limit = int(request.query.get("limit", 50))
+        owned = [
+            {"id": id, "name": playlist.name}
+            for id, playlist in self.playlists.items()
+            if id != "bench"
+        ]
+
+        return web.json_response(
+            {
+                "items": owned[offset : offset + limit],
+                "offset": offset,
+                "limit": limit,
+                "total": len(owned),
+            }
+        )
+
+    async def create_playlist(self, request: web.Request) -> web.Response:
+        body: dict[str, Any] = await request.json()
+        id = f"p{len(self.playlists):021d}"
+        self.playlists[id] = Playlist(body["name"], [])
+
+        return web.json_response(
+            {
+                "id": id,
+                "name": body["name"],
+                "external_urls": {"spotify": f"https://open.spotify.com/playlist/{id}"},
+            },
+            status=201,
+        )
+
+    async def search(self, request: web.Request) -> web.Response:
+        limit = int(request.query.get("limit", 10))
+        index = self.catalog.index(request.query.get("q", ""))
+
+        items = [] if index is None else [self.catalog.track(index)][:limit]
+        return web.json_response({"tracks": {"items": items, "total": len(items)}})
+
+    async def albums(self, request: web.Request) -> web.Response:
+        albums: list[dict[str, Any] | None] = []
+        for id in request.query["ids"].split(","):
+            album = int(id[1:])
+            in_catalog = album * self.catalog.album_size < self.catalog.size
+            albums.append(self.catalog.album(album) if in_catalog else None)
+
+        return web.json_response({"albums": albums})
+
+    async def album(self, request: web.Request) -> web.Response:
+        return web.json_response(self.catalog.album(int(request.match_info["id"][1:])))
+
+    async def album_tracks(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            self.catalog.album_tracks(
+                int(request.match_info["id"][1:]),
+                int(request.query.get("offset", 0)),
+                int(request.query.get("limit", 50)),
+            )
+        )
+
+
+@dataclass
+class FakeDeemix:
+    # Deemix and the public Deezer API, served from the same port
+    catalog: Catalog
+    faults: Faults
+    requests: Counter[str] = field(default_factory=Counter)
+    queued: int = 0
+
+    def reset(self, catalog: Catalog) -> None:
+        self.catalog = catalog
+        self.requests.clear()
+        self.queued = 0
+
+    @web.middleware
+    async def middleware(self, request: web.Request, handler: Handler) -> Any:
+        route = request.match_info.route.resource
+        name = route.canonical if route is not None else request.path
+        self.requests[f"{request.method} {name}"] += 1
+
+        await asyncio.sleep(self.faults.latency)
+        return await handler(request)
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_get("/api/mainSearch", self.main_search)
+        app.router.add_get("/api/connect", self.connect)
+        app.router.add_post("/api/loginArl", self.login)
+        app.router.add_post("/api/addToQueue", self.add_to_queue)
+        app.router.add_get("/track/{isrc}", self.isrc)
+        return app
+
+    async def main_search(self, request: web.Request) -> web.Response:
+        index = self.catalog.index(request.query.get("term", ""))
+
+        # Real results come with a few near misses around the match
+        data = (
+            []
+            if index is None
+            else [self.catalog.deezer_track(i) for i in (index, index + 1, index + 2)]
+        )
+        return web.json_response({"TRACK": {"data": data, "total": len(data)}})
+
+    async def connect(self, request: web.Request) -> web.Response:
+        return web.json_response({"autologin": False})
+
+    async def login(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": 1})
+
+    async def add_to_queue(self, request: web.Request) -> web.Response:
+        data = await request.post()
+        self.queued += len(str(data["url"]).split(";"))
+        return web.json_response({"result": True, "data": {}})
+
+    async def isrc(self, request: web.Request) -> web.Response:
+        isrc = request.match_info["isrc"].removeprefix("isrc:")
+        index = int(isrc.removeprefix("BENCH")) if isrc.startswith("BENCH") else None
+
+        # Every fourth track isn't known by its ISRC and falls back to search
+        if index is None or index >= self.catalog.size or index % 4 == 0:
+            return web.json_response({"error": {"type": "DataException", "code": 800}})
+
+        return web.json_response(
+            {
+                "id": 100_000 + index,
+                "readable": True,
+                "title": f"Song {index}",
+                "artist": {"name": self.catalog.artist(index)["name"]},
+            }
+        )
@@ -0,0 +1,73 @@
+import subprocess
+import sys
+
+import click
+
+# Modules only the converters need, none of them should load with the CLI
+HEAVY_MODULES = ("aiohttp", "rapidfuzz", "selenium", "spotipy", "tqdm")
+
+
+def import_times(module: str) -> dict[str, int]:
+    # -X importtime writes "import time: self | cumulative | name" to stderr
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    times: dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        times[name.strip()] = int(cumulative)
+
+    return times
+
+
+@click.command()
+@click.option(
+    "--budget",
+    type=click.FloatRange(min=0),
+    help="Most milliseconds importing the CLI may take.",
+    default=150,
+    show_default=True,
+)
+@click.option(
+    "--runs",
+    type=click.IntRange(min=1),
+    help="Imports to time, the fastest one counts.",
+    default=5,
+    show_default=True,
+)
+def main(budget: float, runs: int) -> None:
+    """Check the spoteemix CLI imports within its time budget."""
+    best: dict[str, int] | None = None
+    for _ in range(runs):
+        times = import_times("spoteemix.__main__")
+        if best is None or times["spoteemix.__main__"] < best["spoteemix.__main__"]:
+            best = times
+
+    assert best is not None
+    total = best["spoteemix.__main__"] / 1000
+
+    click.echo(f"spoteemix.__main__ imports in {total:.1f} ms", nl=False)
+    click.echo(f" (budget {budget:.0f} ms, best of {runs}).")
+
+    for name, cumulative in sorted(best.items(), key=lambda item: -item[1])[:10]:
+        click.echo(f"{cumulative / 1000:8.1f} ms  {name}")
+
+    heavy = [name for name in HEAVY_MODULES if name in best]
+    if heavy:
+        raise click.ClickException(f"CLI startup imports {', '.join(heavy)}.")
+
+    if total > budget:
+        raise click.ClickException(
+            f"CLI startup is over budget by {total - budget:.1f} ms."
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+import click
+from aiohttp import web
+from fakes import Catalog, FakeDeemix, FakeSpotify, Faults
+
+SCENARIOS = ("std", "fts", "albums", "shuffle")
+
+CLIENT_ID = "0123456789abcdef0123456789abcdef"
+CLIENT_SECRET = "fedcba9876543210fedcba9876543210"
+PLAYLIST_URL = "https://open.spotify.com/playlist/bench"
+
+CLI = "from spoteemix.__main__ import cli; cli()"
+
+
+class Servers:
+    def __init__(self, spotify: FakeSpotify, deemix: FakeDeemix) -> None:
+        # The fakes run in their own thread, the CLI runs as a child process
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        self.runners: list[web.AppRunner] = []
+        self.spotify_url = self._start(spotify.app())
+        self.deemix_url = self._start(deemix.app())
+
+    def _start(self, app: web.Application) -> str:
+        async def start() -> str:
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            self.runners.append(runner)
+
+            host, port = runner.addresses[0][:2]
+            return f"http://{host}:{port}"
+
+        return asyncio.run_coroutine_threadsafe(start(), self.loop).result()
+
+    def close(self) -> None:
+        for runner in self.runners:
+            asyncio.run_coroutine_threadsafe(runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def seed_user_token(config_dir: Path) -> None:
+    # Stands in for the browser OAuth flow, in spotipy's cache format
+    tokens = config_dir / "spoteemix" / "tokens"
+    tokens.mkdir(parents=True, exist_ok=True)
+    (tokens / f"{CLIENT_ID}.user.json").write_text(
+        json.dumps(
+            {
+                "access_token": "user-token",
+                "token_type": "Bearer",
+                "expires_in": 3600,
+                "scope": "playlist-modify-private playlist-read-private",
+                "expires_at": int(time.time()) + 24 * 60 * 60,
+                "refresh_token": "refresh-token",
+            }
+        )
+    )
+
+
+def build_library(root: Path, catalog: Catalog) -> None:
+    # Empty files, the tracks are read from their "Artist - Title" names
+    for index in range(catalog.size):
+        folder = root / f"{index // 100:04d}"
+        folder.mkdir(exist_ok=True)
+        artist = catalog.artist(index)["name"]
+        (folder / f"{artist} - Song {index}.mp3").touch()
+
+
+def scenario_args(scenario: str, servers: Servers, work_dir: Path) -> list[str]:
+    if scenario == "std":
+        # ISRC lookups are held to Deezer's public rate limit, they'd
+        # measure that limit instead of the pipeline
+        return [
+            "convert",
+            "std",
+            PLAYLIST_URL,
+            "--deemix",
+            servers.deemix_url,
+            "--rate",
+            "0",
+            "--no-cache",
+            "--no-isrc",
+            "--full",
+        ]
+
+    if scenario == "fts":
+        return ["convert", "fts", str(work_dir / "library"), "Bench"]
+
+    if scenario == "albums":
+        return ["utils", "albums", PLAYLIST_URL]
+
+    return ["utils", "sp-shuffle", PLAYLIST_URL, "--mode", "local", "--seed", "1"]
+
+
+def run_cli(
+    args: list[str], env: dict[str, str], stdin: str
+) -> tuple[float, int, float]:
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-c", CLI, *args],
+        env=env,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    assert process.stdin is not None
+    process.stdin.write(stdin)
+    process.stdin.close()
+
+    # wait4 gives the resource usage of this child alone
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return wall, process.returncode, usage.ru_maxrss * scale / 2**20
+
+
+def run_scenario(
+    scenario: str,
+    tracks: int,
+    servers: Servers,
+    spotify: FakeSpotify,
+    deemix: FakeDeemix,
+) -> dict[str, Any]:
+    catalog = Catalog(tracks)
+    spotify.reset(catalog)
+    deemix.reset(catalog)
+
+    with tempfile.TemporaryDirectory(prefix="spoteemix-bench-") as tmp:
+        work_dir = Path(tmp)
+
+        # A fresh config dir per run, nothing is reused from an earlier one
+        config_dir = work_dir / "config"
+        seed_user_token(config_dir)
+
+        if scenario == "fts":
+            (work_dir / "library").mkdir()
+            build_library(work_dir / "library", catalog)
+
+        env = os.environ | {
+            "XDG_CONFIG_HOME": str(config_dir),
+            "SPOTIPY_CLIENT_ID": CLIENT_ID,
+            "SPOTIPY_CLIENT_SECRET": CLIENT_SECRET,
+            "SPOTEEMIX_SPOTIFY_API_URL": f"{servers.spotify_url}/v1",
+            "SPOTEEMIX_SPOTIFY_TOKEN_URL": f"{servers.spotify_url}/api/token",
+            "SPOTEEMIX_DEEZER_API_URL": servers.deemix_url,
+        }
+
+        # Albums asks which albums to use and confirms the new playlist
+        stdin = "1-5\ny\ny\n" if scenario == "albums" else ""
+
+        # The CLI's own report tells where inside the run the time went
+        metrics_path = work_dir / "metrics.json"
+        wall, exit_code, peak_rss = run_cli(
+            [
+                "--metrics",
+                str(metrics_path),
+                *scenario_args(scenario, servers, work_dir),
+            ],
+            env,
+            stdin,
+        )
+        metrics = (
+            json.loads(metrics_path.read_text()) if metrics_path.exists() else None
+        )
+
+    return {
+        "scenario": scenario,
+        "tracks": tracks,
+        "exit_code": exit_code,
+        "wall_seconds": round(wall, 3),
+        "tracks_per_second": round(tracks / wall, 1),
+        "peak_rss_mb": round(peak_rss, 1),
+        "spotify_requests": dict(sorted(spotify.requests.items())),
+        "deemix_requests": dict(sorted(deemix.requests.items())),
+        "queued": deemix.queued,
+        "metrics": metrics,
+    }
+
+
+@click.command()
+@click.option(
+    "--tracks",
+    "-t",
+    type=click.IntRange(min=100, max=50_000),
+    multiple=True,
+    help="Catalog and playlist size, can be repeated.",
+    default=[100, 1000],
+    show_default=True,
+)
+@click.option(
+    "--scenario",
+    "-s",
+    type=click.Choice(SCENARIOS),
+    multiple=True,
+    help="Commands to run, all of them by default.",
+)
+@click.option(
+    "--latency",
+    type=click.FloatRange(min=0),
+    help="Milliseconds every fake request takes.",
+    default=20,
+    show_default=True,
+)
+@click.option(
+    "--rate-limit-every",
+    type=click.IntRange(min=0),
+    help="Answer every nth Spotify request with 429, 0 to never.",
+    default=0,
+    show_default=True,
+)
+@click.option(
+    "--retry-after",
+    type=click.FloatRange(min=0),
+    help="Seconds the injected 429 responses ask to wait.",
+    default=1,
+    show_default=True,
+)
+@click.option(
+    "--output",
+    "-o",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Write the results here instead of stdout.",
+)
+def main(
+    tracks: tuple[int, ...],
+    scenario: tuple[str, ...],
+    latency: float,
+    rate_limit_every: int,
+    retry_after: float,
+    output: Path | None,
+) -> None:
+    """Run spoteemix commands against local fakes of Spotify and Deemix.
+
+    Results are written as JSON, one entry per command and playlist size.
+    """
+    faults = Faults(latency / 1000, rate_limit_every, retry_after)
+    spotify = FakeSpotify(Catalog(0), faults)
+    deemix = FakeDeemix(Catalog(0), faults)
+    servers = Servers(spotify, deemix)
+
+    results: list[dict[str, Any]] = []
+    try:
+        for size in tracks:
+            for name in scenario or SCENARIOS:
+                result = run_scenario(name, size, servers, spotify, deemix)
+                results.append(result)
+
+                click.echo(
+                    f"{name:>8} {size:>6} tracks: {result['wall_seconds']:8.2f} s,"
+                    f" {result['tracks_per_second']:8.1f} tracks/s,"
+                    f" {result['peak_rss_mb']:6.1f} MB"
+                    + (f", exit {result['exit_code']}" if result["exit_code"] else ""),
+                    err=True,
+                )
+    finally:
+        servers.close()
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "latency_ms": latency,
+        "rate_limit_every": rate_limit_every,
+        "results": results,
+    }
+
+    if output is None:
+        click.echo(json.dumps(report, indent=2))
+    else:
+        output.write_text(json.dumps(report, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
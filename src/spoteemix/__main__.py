@@ -1,16 +1,15 @@
+from pathlib import Path
 from typing import Any
 
 import click
 
-from spoteemix.commands import convert, utils
-from spoteemix.config_helper import load_configs
-from spoteemix.helpers.command_helpers import SpotifyClient
+from spoteemix.commands import convert, utils, watch
+from spoteemix.helpers.command_helpers import ConfigGroup, SpotifyClient
 
-DEFAULT_CONFIG: dict[str, Any] = dict(default_map=load_configs())
-DEFAULT_CONFIG["help_option_names"] = ["-h", "--help"]
+DEFAULT_CONFIG: dict[str, Any] = dict(help_option_names=["-h", "--help"])
 
 
-@click.group(context_settings=DEFAULT_CONFIG)
+@click.group(cls=ConfigGroup, context_settings=DEFAULT_CONFIG)
 @click.option(
     "--client-id",
     type=click.STRING,
@@ -25,8 +24,26 @@ DEFAULT_CONFIG["help_option_names"] = ["-h", "--help"]
     required=True,
     envvar="SPOTIPY_CLIENT_SECRET",
 )
+@click.option(
+    "--metrics",
+    "metrics_path",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    help="Write request counts, timings and stage stats as JSON here.",
+)
+@click.option(
+    "--prometheus",
+    "prometheus_path",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    help="Write the metrics in Prometheus text format here, for watch after each poll.",
+)
 @click.pass_context
-def cli(ctx: click.Context, client_id: str, client_secret: str) -> None:
+def cli(
+    ctx: click.Context,
+    client_id: str,
+    client_secret: str,
+    metrics_path: Path | None,
+    prometheus_path: Path | None,
+) -> None:
     ctx.ensure_object(dict)
 
     if len(client_id) != 32 or not client_id.isalnum():
@@ -37,8 +54,13 @@ def cli(ctx: click.Context, client_id: str, client_secret: str) -> None:
 
     ctx.obj = SpotifyClient(client_id, client_secret)
 
-    pass
+    # Written when the command ends, even when it fails or is interrupted
+    if metrics_path is not None or prometheus_path is not None:
+        ctx.obj.metrics.json_path = metrics_path
+        ctx.obj.metrics.prometheus_path = prometheus_path
+        ctx.call_on_close(ctx.obj.metrics.write)
 
 
 cli.add_command(convert)
 cli.add_command(utils)
+cli.add_command(watch)
@@ -1,10 +1,10 @@
+from collections.abc import Callable
 from pathlib import Path
+from typing import TextIO, cast
 
 import click
 
-from spoteemix.convert import file_to_spotify, spotify_to_deemix
 from spoteemix.helpers.command_helpers import SpotifyClient, pass_spotify
-from spoteemix.utils import albums_from_playlist, shuffle_spotify
 
 
 @click.group()
@@ -12,46 +12,270 @@ def convert() -> None:
     pass
 
 
+def deemix_options(command: Callable[..., None]) -> Callable[..., None]:
+    # Shared by every command that mirrors playlists into Deemix
+    options = [
+        click.option(
+            "--deemix",
+            "-d",
+            type=click.STRING,
+            help="URL of the Deemix instance.",
+            default="http://127.0.0.1:6595",
+            show_default=True,
+        ),
+        click.option(
+            "--format",
+            "-f",
+            type=click.Choice(["flac", "mp3_320", "mp3_128"], case_sensitive=False),
+            help="Preferred audio format",
+            default="mp3_320",
+            show_default=True,
+        ),
+        click.option(
+            "--concurrency",
+            "-c",
+            type=click.IntRange(min=1),
+            help="Maximum simultaneous Deemix searches.",
+            default=8,
+            show_default=True,
+        ),
+        click.option(
+            "--rate",
+            "-r",
+            type=click.FloatRange(min=0),
+            help="Maximum Deemix searches per second, 0 for no limit.",
+            default=10,
+            show_default=True,
+        ),
+        click.option(
+            "--cache/--no-cache",
+            "use_cache",
+            help="Reuse matches found on earlier runs.",
+            default=True,
+            show_default=True,
+        ),
+        click.option(
+            "--queue",
+            "queue_backend",
+            type=click.Choice(["http", "selenium"], case_sensitive=False),
+            help="How to add tracks to the Deemix queue.",
+            default="http",
+            show_default=True,
+        ),
+        click.option(
+            "--arl",
+            type=click.STRING,
+            help="Deezer ARL to log Deemix in with, if it doesn't have one stored.",
+            envvar="DEEMIX_ARL",
+        ),
+        click.option(
+            "--isrc/--no-isrc",
+            "use_isrc",
+            help="Look tracks up by ISRC on Deezer before searching by name.",
+            default=True,
+            show_default=True,
+        ),
+        click.option(
+            "--hedge",
+            is_flag=True,
+            help="Send the fallback searches before the first one has failed.",
+        ),
+        click.option(
+            "--hedge-delay",
+            type=click.FloatRange(min=0),
+            help="Seconds between hedged searches, risky titles don't wait.",
+            default=0.3,
+            show_default=True,
+        ),
+    ]
+
+    for option in reversed(options):
+        command = option(command)
+
+    return command
+
+
+def check_urls(deemix: str, playlists: list[str]) -> None:
+    if "http" not in deemix:
+        raise click.UsageError(
+            "Deemix URL doesn't start with http(s) or is otherwise malformed."
+        )
+
+    for link in playlists:
+        if "http" not in link:
+            raise click.UsageError(
+                f"Playlist URL {link} doesn't start with http(s) or is otherwise malformed."
+            )
+
+
 @click.command()
-@click.argument("playlist", type=click.STRING)
+@click.argument("playlist", nargs=-1, type=click.STRING)
 @click.option(
-    "--deemix",
-    "-d",
-    type=click.STRING,
-    help="URL of the Deemix instance.",
-    default="http://127.0.0.1:6595",
-    show_default=True,
+    "--from-file",
+    type=click.File("r"),
+    help="File with more playlist URLs, one per line.",
 )
+@deemix_options
 @click.option(
-    "--format",
-    "-f",
-    type=click.Choice(["flac", "mp3_320", "mp3_128"], case_sensitive=False),
-    help="Preferred audio format",
-    default="mp3_320",
-    show_default=True,
+    "--refresh",
+    is_flag=True,
+    help="Search every track again and overwrite cached matches.",
+)
+@click.option(
+    "--full",
+    is_flag=True,
+    help="Process every track, not just those added since the last run.",
 )
 @pass_spotify
-def std(spotify: SpotifyClient, playlist: str, deemix: str, format: str) -> None:
-    """Download Spotify playlist using Deemix.
+def std(
+    spotify: SpotifyClient,
+    playlist: tuple[str, ...],
+    from_file: TextIO | None,
+    deemix: str,
+    format: str,
+    concurrency: int,
+    rate: float,
+    use_cache: bool,
+    queue_backend: str,
+    arl: str | None,
+    use_isrc: bool,
+    hedge: bool,
+    hedge_delay: float,
+    refresh: bool,
+    full: bool,
+) -> None:
+    """Download Spotify playlists using Deemix.
 
-    PLAYLIST - the URL of the Spotify playlist to download.
+    PLAYLIST - the URLs of the Spotify playlists to download.
     """
-    if "http" not in deemix:
-        raise click.UsageError(
-            "Deemix URL doesn't start with http(s) or is otherwise malformed."
-        )
+    # Converters pull in aiohttp, rapidfuzz and tqdm, only import the one
+    # that runs so --help and the other commands start fast
+    from spoteemix.convert import spotify_to_deemix
 
-    if "http" not in playlist:
-        raise click.UsageError(
-            "Playlist URL doesn't start with http(s) or is otherwise malformed."
+    check_urls(deemix, list(playlist))
+
+    # Blank lines and # comments are allowed in the file, malformed lines
+    # are skipped when the batch runs instead of stopping it
+    playlists = list(playlist)
+    if from_file is not None:
+        playlists.extend(
+            line.strip()
+            for line in from_file
+            if line.strip() and not line.lstrip().startswith("#")
         )
 
+    if len(playlists) == 0:
+        raise click.UsageError("Pass at least one PLAYLIST or --from-file.")
+
     spotify_to_deemix.main(
-        client_id=spotify.id,
-        client_secret=spotify.secret,
+        spotify=spotify,
         deemix_url=deemix,
         pref_file=format,
-        playlist_link=playlist,
+        playlist_links=playlists,
+        concurrency=concurrency,
+        rate=rate,
+        use_cache=use_cache,
+        refresh=refresh,
+        queue_backend=queue_backend,
+        arl=arl,
+        use_isrc=use_isrc,
+        hedge_delay=hedge_delay if hedge else None,
+        full=full,
+    )
+
+
+@click.command()
+@click.argument("playlist", nargs=-1, type=click.STRING)
+@deemix_options
+@click.option(
+    "--interval",
+    "-i",
+    type=click.FloatRange(min=10),
+    help="Seconds between checks of a playlist.",
+    default=300,
+    show_default=True,
+)
+@click.option(
+    "--jitter",
+    type=click.FloatRange(min=0, max=1),
+    help="Random spread of each interval, as a fraction of it.",
+    default=0.1,
+    show_default=True,
+)
+@pass_spotify
+def watch(
+    spotify: SpotifyClient,
+    playlist: tuple[str, ...],
+    deemix: str,
+    format: str,
+    concurrency: int,
+    rate: float,
+    use_cache: bool,
+    queue_backend: str,
+    arl: str | None,
+    use_isrc: bool,
+    hedge: bool,
+    hedge_delay: float,
+    interval: float,
+    jitter: float,
+) -> None:
+    """Keep Spotify playlists mirrored into Deemix.
+
+    PLAYLIST - the URLs of the Spotify playlists to watch, more can be
+    listed under "watch" in config.json.
+    """
+    from spoteemix.convert import deemix_watch
+
+    playlists = [(link, interval) for link in playlist]
+
+    # Playlists from the config can have their own interval, held to the
+    # same bounds as --interval
+    interval_type = click.FloatRange(min=10)
+    config = click.get_current_context().default_map or {}
+    entries: object = config.get("playlists", [])
+    if not isinstance(entries, list):
+        raise click.UsageError("Watched playlists in config must be a list.")
+
+    for entry in cast(list[object], entries):
+        if isinstance(entry, str):
+            playlists.append((entry, interval))
+            continue
+
+        if not isinstance(entry, dict):
+            raise click.UsageError(f"Malformed watched playlist {entry} in config.")
+
+        fields = cast(dict[str, object], entry)
+        url = fields.get("url")
+        if not isinstance(url, str):
+            raise click.UsageError(f"Malformed watched playlist {entry} in config.")
+
+        try:
+            playlist_interval: float = interval_type(fields.get("interval", interval))
+        except click.BadParameter as e:
+            raise click.UsageError(
+                f"Malformed interval of watched playlist {url} in config: {e.message}"
+            ) from e
+
+        playlists.append((url, playlist_interval))
+
+    if len(playlists) == 0:
+        raise click.UsageError("Pass at least one PLAYLIST or list them in config.")
+
+    check_urls(deemix, [link for link, _ in playlists])
+
+    deemix_watch.main(
+        spotify=spotify,
+        deemix_url=deemix,
+        pref_file=format,
+        playlists=playlists,
+        concurrency=concurrency,
+        rate=rate,
+        use_cache=use_cache,
+        queue_backend=queue_backend,
+        arl=arl,
+        use_isrc=use_isrc,
+        hedge_delay=hedge_delay if hedge else None,
+        jitter=jitter,
     )
 
 
@@ -62,19 +286,38 @@ def std(spotify: SpotifyClient, playlist: str, deemix: str, format: str) -> None
     type=click.Path(exists=True, file_okay=False, path_type=Path),
 )
 @click.argument("name", type=click.STRING)
+@click.option(
+    "--concurrency",
+    "-c",
+    type=click.IntRange(min=1),
+    help="Maximum simultaneous Spotify searches.",
+    default=8,
+    show_default=True,
+)
+@click.option(
+    "--budget",
+    type=click.IntRange(min=0),
+    help="Maximum Spotify searches in one run, 0 for no limit.",
+    default=0,
+    show_default=True,
+)
 @pass_spotify
-def fts(spotify: SpotifyClient, path: Path, name: str) -> None:
+def fts(
+    spotify: SpotifyClient, path: Path, name: str, concurrency: int, budget: int
+) -> None:
     """Create Spotify playlist from files in PATH.
 
-    PATH - where to search for audio files
+    PATH - where to search for audio files, including subfolders
     NAME - name of the created playlist
     """
+    from spoteemix.convert import file_to_spotify
 
     file_to_spotify.main(
         path=path,
         playlist_name=name,
-        client_id=spotify.id,
-        client_secret=spotify.secret,
+        spotify=spotify,
+        concurrency=concurrency,
+        budget=budget,
     )
 
 
@@ -89,24 +332,62 @@ def utils() -> None:
 
 @click.command()
 @click.argument("playlist", type=click.STRING)
+@click.option(
+    "--mode",
+    type=click.Choice(["local", "random"], case_sensitive=False),
+    help="Move random tracks around, or shuffle the whole playlist at once."
+    " Local rewrites the playlist, which resets the dates tracks were added,"
+    " unless --keep-items is given.",
+    default="random",
+    show_default=True,
+)
 @click.option(
     "-i",
     "--iter",
     default=500,
     type=int,
-    help="Amount of time to randomly move tracks.",
+    help="Amount of time to randomly move tracks, with --mode random.",
+)
+@click.option(
+    "--seed",
+    type=int,
+    help="Seed for a repeatable shuffle.",
+)
+@click.option(
+    "--no-repeat-artist",
+    is_flag=True,
+    help="Avoid the same artist twice in a row.",
+)
+@click.option(
+    "--keep-items",
+    is_flag=True,
+    help="Move tracks instead of rewriting the playlist with --mode local,"
+    " keeps their added dates.",
 )
 @pass_spotify
-def sp_shuffle(spotify: SpotifyClient, playlist: str, iter: int) -> None:
+def sp_shuffle(
+    spotify: SpotifyClient,
+    playlist: str,
+    mode: str,
+    iter: int,
+    seed: int | None,
+    no_repeat_artist: bool,
+    keep_items: bool,
+) -> None:
     """Shuffle the order of tracks in a Spotify playlist.
 
     PLAYLIST - the URL of the Spotify playlist to download.
     """
+    from spoteemix.utils import shuffle_spotify
+
     shuffle_spotify.main(
-        client_id=spotify.id,
-        client_secret=spotify.secret,
+        spotify=spotify,
         playlist_link=playlist,
+        mode=mode,
         iterations=iter,
+        seed=seed,
+        no_repeat_artist=no_repeat_artist,
+        keep_items=keep_items,
     )
 
 
@@ -118,9 +399,10 @@ def albums(spotify: SpotifyClient, playlist: str) -> None:
 
     PLAYLIST - the URL of the Spotify playlist to download.
     """
+    from spoteemix.utils import albums_from_playlist
+
     albums_from_playlist.main(
-        client_id=spotify.id,
-        client_secret=spotify.secret,
+        spotify=spotify,
         playlist_link=playlist,
     )
 
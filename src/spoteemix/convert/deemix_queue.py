@@ -0,0 +1,249 @@
+import asyncio
+from abc import ABC, abstractmethod
+from time import sleep
+from typing import TYPE_CHECKING, Any, Self
+
+import aiohttp
+import click
+
+from spoteemix.helpers.tracks import DeezerTrack
+
+if TYPE_CHECKING:
+    from selenium.webdriver.firefox.webdriver import WebDriver
+
+# deemix LoginStatus values that mean the session can queue downloads
+LOGGED_IN = (1, 2, 3)
+
+
+def deezer_track_url(track: DeezerTrack) -> str:
+    return f"https://www.deezer.com/track/{track.sng_id}"
+
+
+class DeemixQueue(ABC):
+    batch_size = 1
+    # Batches sent at once
+    concurrency = 1
+
+    def __init__(self, deemix_url: str) -> None:
+        self.deemix_url = deemix_url
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *_: object) -> None:
+        # Backends without a connection have nothing to close
+        return None
+
+    @abstractmethod
+    async def add(self, urls: list[str]) -> int: ...
+
+
+class HttpQueue(DeemixQueue):
+    def __init__(
+        self,
+        deemix_url: str,
+        arl: str | None = None,
+        batch_size: int = 25,
+        concurrency: int = 2,
+    ) -> None:
+        super().__init__(deemix_url)
+        self.arl = arl
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+
+        self._session: aiohttp.ClientSession | None = None
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._login_lock = asyncio.Lock()
+
+    async def __aenter__(self) -> Self:
+        # Deemix keeps the login in a cookie session, so all requests share a jar
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(total=60),
+        )
+
+        # __aexit__ doesn't run when entering fails, watch would leak a
+        # session on every poll
+        try:
+            await self.login()
+        except BaseException:
+            await self.__aexit__()
+            raise
+
+        return self
+
+    async def __aexit__(self, *_: object) -> None:
+        if self._session is not None:
+            await self._session.close()
+        self._session = None
+
+    async def _json(self, method: str, path: str, **kwargs: Any) -> dict[str, Any]:
+        assert self._session is not None
+        async with self._session.request(
+            method, f"{self.deemix_url}{path}", **kwargs
+        ) as resp:
+            resp.raise_for_status()
+            json_data: dict[str, Any] = await resp.json()
+            return json_data
+
+    async def login(self) -> None:
+        async with self._login_lock:
+            connect = await self._json("GET", "/api/connect")
+
+            # autologin means this session isn't logged in yet
+            if not connect.get("autologin", True):
+                return
+
+            arl = self.arl
+            if arl is None and connect.get("singleUser"):
+                arl = connect["singleUser"].get("arl")
+
+            if arl is None:
+                raise click.ClickException(
+                    f"Deemix at {self.deemix_url} isn't logged in, pass --arl."
+                )
+
+            response = await self._json("POST", "/api/loginArl", json={"arl": arl})
+
+            if response.get("status") not in LOGGED_IN:
+                raise click.ClickException(
+                    "Couldn't log in to Deemix, "
+                    f"check if your ARL is up to date at {self.deemix_url}."
+                )
+
+    async def add(self, urls: list[str]) -> int:
+        # Deemix splits the url field on ';', so one request queues a batch
+        data = {"url": ";".join(urls), "bitrate": "null"}
+
+        async with self._semaphore:
+            response = await self._json("POST", "/api/addToQueue", data=data)
+
+            if not response.get("result") and response.get("errid") == "NotLoggedIn":
+                await self.login()
+                response = await self._json("POST", "/api/addToQueue", data=data)
+
+        if not response.get("result"):
+            click.echo(
+                "Unable to queue {} tracks due to {}.".format(
+                    len(urls), response.get("errid")
+                ),
+                err=True,
+            )
+            return 0
+
+        return len(urls)
+
+
+class SeleniumQueue(DeemixQueue):
+    def __init__(self, deemix_url: str) -> None:
+        super().__init__(deemix_url)
+        self._driver: WebDriver | None = None
+
+    async def __aenter__(self) -> Self:
+        self._driver = await asyncio.to_thread(initiate_selenium, self.deemix_url)
+        return self
+
+    async def __aexit__(self, *_: object) -> None:
+        if self._driver is not None:
+            await asyncio.to_thread(self._driver.quit)
+        self._driver = None
+
+    def _add(self, urls: list[str]) -> None:
+        assert self._driver is not None
+        for url in urls:
+            data = {"bitrate": "null", "url": url}
+            selenium_post(self._driver, self.deemix_url, "/api/addToQueue", data)
+            sleep(0.5)
+
+    async def add(self, urls: list[str]) -> int:
+        await asyncio.to_thread(self._add, urls)
+        return len(urls)
+
+
+def open_queue(backend: str, deemix_url: str, arl: str | None) -> DeemixQueue:
+    if backend == "selenium":
+        return SeleniumQueue(deemix_url)
+
+    return HttpQueue(deemix_url, arl=arl)
+
+
+def selenium_post(
+    driver: WebDriver, deemix_url: str, path: str, params: dict[str, str]
+) -> None:
+    from selenium.common.exceptions import NoAlertPresentException, TimeoutException
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.wait import WebDriverWait
+
+    driver.execute_script(  # type: ignore[reportUnknownMemberType]
+        """
+    function post(url, path, params, method='post') {
+        const form = document.createElement('form');
+        form.method = method;
+        form.action = url + path;
+
+        for (const key in params) {
+            if (params.hasOwnProperty(key)) {
+            const hiddenField = document.createElement('input');
+            hiddenField.type = 'hidden';
+            hiddenField.name = key;
+            hiddenField.value = params[key];
+
+            form.appendChild(hiddenField);
+        }
+    }
+
+    document.body.appendChild(form);
+    form.submit();
+    }
+
+    post(arguments[0], arguments[1], arguments[2]);
+    """,
+        deemix_url,
+        path,
+        params,
+    )
+    # Sometimes when connecting with http, an alert dialog appears
+    try:
+        WebDriverWait(driver, 2).until(
+            EC.alert_is_present(),
+            "Timed out waiting for PA creation " + "confirmation popup to appear.",
+        )
+
+        alert = driver.switch_to.alert
+        alert.accept()
+    except TimeoutException:
+        pass
+    except NoAlertPresentException:
+        pass
+
+
+def initiate_selenium(deemix_url: str) -> WebDriver:
+    # Selenium is only needed for this fallback, don't import it otherwise
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.firefox.options import Options as FirefoxOptions
+    from selenium.webdriver.firefox.webdriver import WebDriver
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.wait import WebDriverWait
+
+    options = FirefoxOptions()
+    options.add_argument("-headless")
+    driver = WebDriver(options=options)
+
+    driver.get(deemix_url)
+
+    try:
+        WebDriverWait(driver, 10).until(
+            EC.presence_of_element_located(
+                (
+                    By.XPATH,
+                    '//span[text()="Logged in"]',
+                )
+            )
+        )
+    except TimeoutException as e:
+        driver.quit()
+        raise click.ClickException(
+            f"Couldn't log in to Deemix, check if your ARL is up to date at {deemix_url}."
+        ) from e
+    return driver
@@ -0,0 +1,152 @@
+import asyncio
+import random
+from dataclasses import dataclass
+from datetime import datetime
+
+import aiohttp
+import click
+
+from spoteemix.convert.spotify_to_deemix import (
+    DeemixMirror,
+    get_spotify_playlist_id,
+    open_mirror,
+)
+from spoteemix.helpers.command_helpers import SpotifyClient
+from spoteemix.helpers.match_cache import MatchCache
+from spoteemix.helpers.playlist_state import PlaylistState
+from spoteemix.helpers.request_cache import RequestCache
+
+
+@dataclass
+class WatchedPlaylist:
+    playlist_id: str
+    interval: float
+    due_at: float = 0.0
+
+
+def log(message: str, err: bool = False) -> None:
+    click.echo(f"[{datetime.now():%Y-%m-%d %H:%M:%S}] {message}", err=err)
+
+
+async def poll_playlist(mirror: DeemixMirror, playlist: WatchedPlaylist) -> None:
+    try:
+        report = await mirror.mirror(playlist.playlist_id)
+    except click.ClickException as e:
+        mirror.sp.metrics.inc(
+            "errors_total", stage="watch poll", error=e.__class__.__name__
+        )
+        log(f"Unable to sync {playlist.playlist_id}: {e.format_message()}", err=True)
+        return
+    except (aiohttp.ClientError, TimeoutError) as e:
+        # Spotify or Deemix being away for a while doesn't stop the watch,
+        # the playlist is tried again on its next turn
+        mirror.sp.metrics.inc(
+            "errors_total", stage="watch poll", error=e.__class__.__name__
+        )
+        log(f"Unable to sync {playlist.playlist_id} due to {e.__class__}.", err=True)
+        return
+
+    if report.unchanged:
+        return
+
+    log(
+        f"{report.name}: {report.queued}/{report.total - report.skipped}"
+        f" new tracks queued, {len(report.not_found)} not found,"
+        f" {len(report.errored)} failed."
+    )
+
+    for track in report.not_found:
+        log(f"Couldn't find {track.name} - {', '.join(track.artists)}")
+
+    for track in report.errored:
+        log(f"Couldn't search for {track.name} - {', '.join(track.artists)}", err=True)
+
+
+async def watch_playlists(
+    mirror: DeemixMirror,
+    playlists: list[WatchedPlaylist],
+    jitter: float,
+    cache: MatchCache | None,
+) -> None:
+    loop = asyncio.get_running_loop()
+
+    # Playlists sharing an interval would otherwise always poll together
+    for playlist in playlists:
+        playlist.due_at = loop.time() + random.uniform(0, playlist.interval * jitter)
+
+    while True:
+        playlist = min(playlists, key=lambda playlist: playlist.due_at)
+        await asyncio.sleep(max(0, playlist.due_at - loop.time()))
+
+        await poll_playlist(mirror, playlist)
+        mirror.forget()
+
+        playlist.due_at = loop.time() + playlist.interval * random.uniform(
+            1 - jitter, 1 + jitter
+        )
+
+        # Matches are kept even if the process is killed instead of stopped
+        if cache is not None:
+            cache.commit()
+
+        # Long running, so scrapers get the metrics after every poll
+        mirror.sp.metrics.write()
+
+
+def main(
+    spotify: SpotifyClient,
+    deemix_url: str,
+    pref_file: str,
+    playlists: list[tuple[str, float]],
+    concurrency: int,
+    rate: float,
+    use_cache: bool,
+    queue_backend: str,
+    arl: str | None,
+    use_isrc: bool,
+    hedge_delay: float | None,
+    jitter: float,
+) -> None:
+    # The same playlist listed twice is polled at its shortest interval
+    intervals: dict[str, float] = {}
+    for link, interval in playlists:
+        playlist_id = get_spotify_playlist_id(link)
+        intervals[playlist_id] = min(interval, intervals.get(playlist_id, interval))
+
+    watched = [
+        WatchedPlaylist(playlist_id, interval)
+        for playlist_id, interval in intervals.items()
+    ]
+
+    cache = MatchCache() if use_cache else None
+    state = PlaylistState(deemix_url, pref_file)
+
+    async def run() -> None:
+        async with open_mirror(
+            spotify,
+            deemix_url,
+            pref_file,
+            concurrency,
+            rate,
+            cache,
+            RequestCache(),
+            queue_backend,
+            arl,
+            use_isrc,
+            hedge_delay,
+            state,
+            full=False,
+        ) as mirror:
+            mirror.verbose = False
+            await watch_playlists(mirror, watched, jitter, cache)
+
+    log(f"Watching {len(watched)} playlists.")
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        log("Stopped watching.")
+    finally:
+        state.close()
+        if cache is not None:
+            cache.close()
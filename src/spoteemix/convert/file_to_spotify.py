@@ -1,138 +1,140 @@
 import asyncio
-import urllib.parse
+from collections.abc import AsyncIterable
+from functools import partial
 from pathlib import Path
 from typing import Any
 
 import click
-import spotipy
-from fuzzywuzzy import fuzz, process
-from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth
-from tqdm.asyncio import tqdm_asyncio
-
-
-def sort_spotify_tracks(
-    track: dict[str, Any], found_tracks: list[Any]
-) -> list[dict[str, Any]]:
-    choices: list[dict[str, Any]] = []
-    for i, found in enumerate(found_tracks):
-        title: str = found["name"]
-        title_ratio: int = fuzz.ratio(title, track["title"])  # type: ignore[reportUnknownMemberType]
-
-        if track["artists"] == []:
-            average_ratio: float = float(title_ratio)
-        else:
-            artist_matches: list[Any] = []
-            for artist in found["artists"]:
-                name: str = artist["name"]
-                matching_artist: Any = process.extractOne(  # type: ignore[reportUnknownMemberType]
-                    name, track["artists"]
-                )
-
-                if matching_artist is not None:
-                    artist_matches.append(matching_artist)
-
-            artist_matches = sorted(artist_matches, key=lambda x: -x[1])
-
-            all_ratios = [title_ratio, *[match[1] for match in artist_matches]]
-            average_ratio = sum(all_ratios) / len(all_ratios)
-
-        choices.append(
-            {
-                "index": i,
-                "confidence": average_ratio,
-            }
-        )
-
-    return sorted(choices, key=lambda x: -x["confidence"])
+from tqdm.auto import tqdm
+
+from spoteemix.helpers.command_helpers import SpotifyClient
+from spoteemix.helpers.library import LibraryIndex, scan_library
+from spoteemix.helpers.playlist_writer import write_playlist
+from spoteemix.helpers.scheduler import SearchScheduler, iterate_in_thread
+from spoteemix.helpers.scoring import Query, Ranking, rank_candidates
+from spoteemix.helpers.spotify_api import SpotifyAPI
+from spoteemix.helpers.tracks import LocalTrack
+
+
+def sort_spotify_tracks(track: LocalTrack, found_tracks: list[Any]) -> Ranking:
+    return rank_candidates(
+        Query(track.title, track.artists),
+        [found["name"] for found in found_tracks],
+        [[artist["name"] for artist in found["artists"]] for found in found_tracks],
+    )
 
 
 def find_best_match(
-    found_tracks: list[Any], choices: list[dict[str, Any]]
-) -> tuple[Any, float]:
-    best_matches: list[dict[str, Any]] = []
-
-    for i, choice in enumerate(choices):
-        if i + 2 > len(choices) or choices[i + 1]["confidence"] < choice["confidence"]:
-            best_matches = choices[: i + 1]
-            break
-
-    return found_tracks[best_matches[0]["index"]], best_matches[0]["confidence"]
+    found_tracks: list[Any], ranking: Ranking
+) -> tuple[str | None, float]:
+    # Only the uri of the match is kept, the playlist is built from those
+    return found_tracks[ranking.order[0]]["uri"], ranking.best
 
 
 async def spotify_track_search(
-    sp: Any, track: dict[str, Any]
-) -> tuple[list[Any], list[dict[str, Any]]]:
+    sp: SpotifyAPI, track: LocalTrack
+) -> tuple[list[Any], Ranking]:
     try:
-        search_terms = f"{track['title']} {' '.join(track['artists'])}"
+        search_terms = f"{track.title} {' '.join(track.artists)}"
 
-        search_term = urllib.parse.quote_plus(search_terms)
-
-        result: dict[str, Any] = sp.search(
-            q=search_term, limit=5, offset=0, type="track"
+        result: dict[str, Any] = await sp.search(
+            q=search_terms, limit=5, offset=0, type="track"
         )
 
         found_tracks: list[Any] = result["tracks"]["items"]
 
-        sorted_tracks = sort_spotify_tracks(track, found_tracks)
-        return found_tracks, sorted_tracks
+        with sp.metrics.time("scoring_seconds"):
+            ranking = sort_spotify_tracks(track, found_tracks)
+
+        return found_tracks, ranking
 
     except TypeError as e:
         print(e)
-        return [], []
+        return [], sort_spotify_tracks(track, [])
     except Exception as e:
+        sp.metrics.inc(
+            "errors_total", stage="spotify search", error=e.__class__.__name__
+        )
         click.echo(
-            "Unable to get url {} due to {}.".format(track["title"], e.__class__),
+            f"Unable to get url {track.title} due to {e.__class__}.",
             err=True,
         )
-        return [], []
+        return [], sort_spotify_tracks(track, [])
 
 
-async def find_track_on_spotify(sp: Any, track: dict[str, Any]) -> tuple[Any, float]:
+async def find_track_on_spotify(
+    sp: SpotifyAPI, track: LocalTrack
+) -> tuple[str | None, float]:
     # Confidence threshold of 75 is an arbitrary magic number
-    found_tracks, sorted_tracks = await spotify_track_search(sp, track)
+    found_tracks, ranking = await spotify_track_search(sp, track)
 
     # Confidence threshold of 60 is an arbitrary magic number
-    if len(found_tracks) == 0 or sorted_tracks[0]["confidence"] < 60:
-        return track, 0
+    if ranking.best < 60:
+        return None, 0
 
-    return find_best_match(found_tracks, sorted_tracks)
+    return find_best_match(found_tracks, ranking)
 
 
 async def tracks_to_spotify(
-    sp: Any, tracks: list[dict[str, Any]]
-) -> tuple[list[Any], list[Any]]:
-    best_matches: list[Any] = []
-    not_found: list[Any] = []
-
-    # Digits of total track count, for n_fmt padding
-    total_digits = str(len(str(len(tracks))))
-
-    ret: list[Any] = await tqdm_asyncio.gather(  # type: ignore[reportUnknownMemberType]
-        *(find_track_on_spotify(sp, track) for track in tracks),
-        desc="Finding songs on Spotify",
-        bar_format="{desc}:  {percentage:3.0f}% {bar} {n:"
-        + total_digits
-        + ".0f}/{total_fmt}",
-        ascii="⣿⣦⣀",
-    )
-
-    for best_match, confidence in ret:
-        if confidence == 0:
-            not_found.append(best_match)
-        else:
-            best_matches.append(best_match)
-
-    return best_matches, not_found
-
-
-def create_spotify_playlist(sp: Any, name: str, matches: list[Any]) -> None:
-    user_id: str = sp.current_user()["id"]
-
-    ret: dict[str, Any] = sp.user_playlist_create(
-        user=user_id,
+    sp: SpotifyAPI,
+    tracks: AsyncIterable[LocalTrack],
+    concurrency: int,
+    budget: int,
+) -> tuple[list[str], list[LocalTrack], list[LocalTrack]]:
+    best_matches: list[tuple[str, str]] = []
+    not_found: list[LocalTrack] = []
+    over_budget: list[LocalTrack] = []
+
+    scheduler = SearchScheduler(max_concurrency=concurrency)
+    sp.metrics.add_collector(partial(scheduler.record, name="spotify search"))
+    searches = 0
+
+    async def find_track(track: LocalTrack) -> tuple[LocalTrack, str | None, float]:
+        nonlocal searches
+
+        # Tracks past the budget are reported instead of searched
+        if budget and searches >= budget:
+            return track, None, -1
+
+        searches += 1
+        match, confidence = await scheduler.submit(find_track_on_spotify, sp, track)
+        return track, match, confidence
+
+    # The library is still being scanned, so the total isn't known
+    with (
+        sp.metrics.stage("spotify search"),
+        tqdm(
+            desc="Finding songs on Spotify",
+            bar_format="{desc}: {n} tracks, {rate_fmt}",
+            ascii="⣿⣦⣀",
+        ) as progress,
+    ):
+        async for track, match, confidence in scheduler.map(find_track, tracks):
+            if confidence < 0:
+                over_budget.append(track)
+            elif match is None:
+                not_found.append(track)
+            else:
+                best_matches.append((track.path, match))
+
+            progress.update()
+
+    sp.metrics.inc("tracks_resolved_total", len(best_matches), path="search")
+    sp.metrics.inc("tracks_resolved_total", len(not_found), path="not found")
+    sp.metrics.inc("tracks_resolved_total", len(over_budget), path="over budget")
+
+    # Completion order is arbitrary, the playlist follows the folder structure
+    best_matches.sort(key=lambda found: found[0])
+
+    return [match for _, match in best_matches], not_found, over_budget
+
+
+async def create_spotify_playlist(
+    sp: SpotifyAPI, name: str, track_uris: list[str]
+) -> None:
+    ret: dict[str, Any] = await sp.current_user_playlist_create(
         name=name,
         public=False,
-        collaborative=False,
         description="Created by spoteemix",
     )
     playlist_id: str = ret["id"]
@@ -144,67 +146,68 @@ def create_spotify_playlist(sp: Any, name: str, matches: list[Any]) -> None:
     click.secho(playlist_id, fg="magenta", nl=False)
     click.echo(".")
 
-    track_ids: list[str] = []
-
-    for match in matches:
-        track_ids.append(match["uri"])
-
-    sp.playlist_add_items(playlist_id, track_ids)
+    await write_playlist(sp, playlist_id, track_uris, existing=[])
 
     click.secho("\nTracks successfuly added to playlist.\n", fg="green")
     click.echo(playlist_link)
 
 
-def parse_files(path: Path) -> list[dict[str, Any]]:
-    mp3_files = path.glob("*.mp3")
-    tracks: list[dict[str, Any]] = []
-
-    for file in mp3_files:
-        track_info = file.name.replace(".mp3", "")
-        try:
-            artist, title = track_info.split(" - ", 1)
-            tracks.append({"artists": [artist], "title": title})
-        except ValueError:
-            tracks.append({"artists": "", "title": track_info})
-
-    return tracks
-
-
-def main(path: Path, playlist_name: str, client_id: str, client_secret: str) -> None:
+async def files_to_playlist(
+    path: Path,
+    playlist_name: str,
+    spotify: SpotifyClient,
+    concurrency: int,
+    budget: int,
+) -> None:
     scope = "playlist-modify-private"
-    sp: Any = spotipy.Spotify(
-        client_credentials_manager=SpotifyClientCredentials(
-            client_id=client_id, client_secret=client_secret
-        )
-    )
 
-    tracks = parse_files(path)
+    # Unchanged files are read from the index instead of their tags
+    index = LibraryIndex()
+
+    # Searching starts with the first scanned files
+    async with spotify.api(max_connections=concurrency) as sp:
+        try:
+            matches, no_matches, over_budget = await tracks_to_spotify(
+                sp, iterate_in_thread(scan_library(path, index)), concurrency, budget
+            )
+        finally:
+            index.close()
+
+        total = len(matches) + len(no_matches) + len(over_budget)
+        click.secho(f"\n{len(matches)}/{total}", fg="green", nl=False)
+        click.echo(" tracks found.\n")
+
+        if len(over_budget) > 0:
+            click.secho(
+                f"{len(over_budget)} tracks weren't searched,"
+                f" the budget of {budget} searches ran out.\n",
+                fg="yellow",
+            )
 
-    matches, no_matches = asyncio.run(tracks_to_spotify(sp, tracks))
+        if len(no_matches) > 0:
+            click.secho("These songs couldn't be found:", fg="red")
 
-    click.secho(f"\n{len(matches)}/{len(tracks)}", fg="green", nl=False)
-    click.echo(" tracks found.\n")
+            for track in no_matches:
+                click.secho(f"{track.title}", fg="blue", nl=False)
 
-    if len(no_matches) > 0:
-        click.secho("These songs couldn't be found:", fg="red")
+                click.echo(" - ", nl=False)
+                click.secho(f"{', '.join(track.artists)}", fg="magenta")
 
-        for track in no_matches:
-            click.secho(f"{track['title']}", fg="blue", nl=False)
+        if len(matches) == 0:
+            click.secho("\n No matches, won't create playlist.", fg="red")
+        else:
+            click.echo("\nStart creating playlist, initiate OAUTH.")
 
-            click.echo(" - ", nl=False)
-            click.secho(f"{', '.join(track['artists'])}", fg="magenta")
+            sp_oauth = spotify.user(sp, scope)
+            with sp.metrics.stage("spotify playlist write"):
+                await create_spotify_playlist(sp_oauth, playlist_name, matches)
 
-    if len(matches) == 0:
-        click.secho("\n No matches, won't create playlist.", fg="red")
-    else:
-        click.echo("\nStart creating playlist, initiate OAUTH.")
 
-        sp_oauth: Any = spotipy.Spotify(
-            auth_manager=SpotifyOAuth(
-                scope=scope,
-                client_id=client_id,
-                client_secret=client_secret,
-                redirect_uri="http://127.0.0.1:8888",
-            )
-        )
-        create_spotify_playlist(sp_oauth, playlist_name, matches)
+def main(
+    path: Path,
+    playlist_name: str,
+    spotify: SpotifyClient,
+    concurrency: int,
+    budget: int,
+) -> None:
+    asyncio.run(files_to_playlist(path, playlist_name, spotify, concurrency, budget))
@@ -1,382 +1,890 @@
 import asyncio
+import os
 import re
-import sys
+import time
 import urllib.parse
-from time import sleep
+from collections import Counter
+from collections.abc import AsyncGenerator, AsyncIterator
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import dataclass, field
+from functools import partial
 from typing import Any
 
 import aiohttp
 import click
-import spotipy
-from fuzzywuzzy import fuzz, process
-from selenium.common.exceptions import NoAlertPresentException, TimeoutException
-from selenium.webdriver.common.by import By
-from selenium.webdriver.firefox.options import Options as FirefoxOptions
-from selenium.webdriver.firefox.webdriver import WebDriver
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.wait import WebDriverWait
-from spotipy.oauth2 import SpotifyClientCredentials
-from tqdm.asyncio import tqdm_asyncio
 from tqdm.auto import tqdm
 
+from spoteemix.convert.deemix_queue import DeemixQueue, deezer_track_url, open_queue
+from spoteemix.helpers.command_helpers import SpotifyClient
+from spoteemix.helpers.match_cache import NEGATIVE_TTL, MatchCache
+from spoteemix.helpers.metrics import Metrics
+from spoteemix.helpers.pagination import paginate
+from spoteemix.helpers.playlist_state import PlaylistState
+from spoteemix.helpers.request_cache import RequestCache, normalize_key
+from spoteemix.helpers.scheduler import SearchScheduler
+from spoteemix.helpers.scoring import Query, Ranking, rank_candidates
+from spoteemix.helpers.spotify_api import SpotifyAPI
+from spoteemix.helpers.tracks import DeezerTrack, SpotifyTrack, intern_artists
+
 pl_regex = re.compile(r".*\/playlist\/(\w*)(\?.*)?")
 short_title_regex = re.compile(r"(\(.+\))")
+# Versions, remixes and features tend to miss on the first search
+risky_title_regex = re.compile(r"[(\[]| - |\bfeat\b|\bft\.", re.IGNORECASE)
+
+DEEZER_API_URL = os.environ.get("SPOTEEMIX_DEEZER_API_URL", "https://api.deezer.com")
+
+# Seconds a queue batch waits for more matches before it's sent anyway
+QUEUE_LINGER = 1.0
+
+# Search variants in cascade order: (expanded, short title, confidence threshold)
+# Sometimes artist names confuse the Deemix search, in these cases try to search only by title
+# Confidence thresholds of 75 and 60 are arbitrary magic numbers
+SEARCH_CASCADE: dict[str, tuple[bool, bool, float]] = {
+    "expanded": (True, False, 75),
+    "title": (False, False, 60),
+    "short title": (True, True, 60),
+}
 
 
 def get_spotify_playlist_id(pl_link: str) -> str:
     if not (pl_match := re.search(pl_regex, pl_link)):
-        sys.exit()
+        raise click.BadParameter(f"{pl_link} isn't a Spotify playlist URL.")
 
     pl_id = pl_match.group(1)
     return f"spotify:playlist:{pl_id}"
 
 
-def get_spotify_playlist_info(sp: Any, pl_id: str) -> None:
-    playlist_info: dict[str, Any] = sp.playlist(pl_id)
+async def get_spotify_playlist_info(sp: SpotifyAPI, pl_id: str) -> dict[str, Any]:
+    playlist_info: dict[str, Any] = await sp.playlist(
+        pl_id, fields="name,owner(display_name),snapshot_id"
+    )
+    return playlist_info
+
+
+def print_playlist_info(playlist_info: dict[str, Any]) -> None:
     click.secho(f"\nDownloading {playlist_info['name']}", fg="blue", nl=False)
     click.echo(" by ", nl=False)
     click.secho(f"{playlist_info['owner']['display_name']}.", fg="magenta")
 
 
-def get_spotify_track_ids(sp: Any, playlist_id: str) -> list[str]:
-    offset = 0
-
-    track_ids: list[str] = []
-
-    while True:
-        response: dict[str, Any] = sp.playlist_items(
+async def spotify_track_pages(
+    sp: SpotifyAPI, playlist_id: str
+) -> AsyncIterator[tuple[int, list[SpotifyTrack]]]:
+    # Track metadata comes with the playlist pages, no need to query each track
+    async for total, items in paginate(
+        partial(
+            sp.playlist_items,
             playlist_id,
-            offset=offset,
-            fields="items.track.id,total",
-            additional_types=["track"],
+            fields="items(item(id,name,artists(name),external_ids(isrc))),total",
+        )
+    ):
+        # Unavailable tracks come back without an item
+        yield (
+            total,
+            [
+                SpotifyTrack.from_item(item["item"])
+                for item in items
+                if item["item"] is not None
+            ],
         )
 
-        if len(response["items"]) == 0:
-            break
-
-        offset = offset + len(response["items"])
 
-        for item in response["items"]:
-            track_ids.append(item["track"]["id"])
+def track_key(track: SpotifyTrack) -> str:
+    # Local files have no id, they're told apart by their metadata
+    if track.id is not None:
+        return track.id
 
-    click.echo(f"Ids gathered for {len(track_ids)} songs.\n")
-    return track_ids
+    return f"local:{track.name}:{','.join(track.artists)}"
 
 
-def spotify_track_query(sp: Any, track_id: str) -> dict[str, Any]:
-    response: dict[str, Any] = sp.track(track_id)
+def sort_deemix_tracks(query: Query, found_tracks: list[DeezerTrack]) -> Ranking:
+    return rank_candidates(
+        query,
+        [found.title for found in found_tracks],
+        [found.artists for found in found_tracks],
+    )
 
-    track: dict[str, Any] = {"name": response["name"], "artists": []}
 
-    for artist in response["artists"]:
-        track["artists"].append(artist["name"])
+def find_best_match(
+    pref_file: str, found_tracks: list[DeezerTrack], ranking: Ranking
+) -> tuple[DeezerTrack, float]:
+    for index in ranking.top():
+        matched_track = found_tracks[index]
 
-    return track
+        if pref_file in matched_track.formats:
+            return matched_track, ranking.best
 
+    # Didn't find good match with preferred file type, return match with highest confidence
+    return found_tracks[ranking.order[0]], ranking.best
 
-async def get_spotify_track_info(sp: Any, track_ids: list[str]) -> list[dict[str, Any]]:
-    tracks: list[dict[str, Any]] = []
 
-    # Digits of total track count, for n_fmt padding
-    total_digits = str(len(str(len(track_ids))))
+@dataclass
+class CascadeStats:
+    attempts: Counter[str] = field(default_factory=Counter)
+    hits: Counter[str] = field(default_factory=Counter)
+    cancelled: Counter[str] = field(default_factory=Counter)
 
-    for track_id in tqdm(
-        track_ids,
-        desc="Track info from Spotify",
-        bar_format="{desc}:  {percentage:3.0f}% {bar} {n:"
-        + total_digits
-        + ".0f}/{total_fmt}",
-        ascii="⣿⣦⣀",
-    ):
-        tracks.append(spotify_track_query(sp, track_id))
-    return tracks
+    def record(self, metrics: Metrics) -> None:
+        for variant, attempts in self.attempts.items():
+            metrics.inc("search_variant_attempts_total", attempts, variant=variant)
+            metrics.inc(
+                "search_variant_hits_total", self.hits[variant], variant=variant
+            )
+            metrics.inc(
+                "search_variant_cancelled_total",
+                self.cancelled[variant],
+                variant=variant,
+            )
 
 
-def selenium_post(
-    driver: WebDriver, deemix_url: str, path: str, params: dict[str, str]
-) -> None:
-    driver.execute_script(  # type: ignore[reportUnknownMemberType]
-        """
-    function post(url, path, params, method='post') {
-        const form = document.createElement('form');
-        form.method = method;
-        form.action = url + path;
-
-        for (const key in params) {
-            if (params.hasOwnProperty(key)) {
-            const hiddenField = document.createElement('input');
-            hiddenField.type = 'hidden';
-            hiddenField.name = key;
-            hiddenField.value = params[key];
-
-            form.appendChild(hiddenField);
-        }
-    }
-
-    document.body.appendChild(form);
-    form.submit();
-    }
-
-    post(arguments[0], arguments[1], arguments[2]);
-    """,
-        deemix_url,
-        path,
-        params,
+@dataclass
+class DeemixSearch:
+    session: aiohttp.ClientSession
+    deemix_url: str
+    scheduler: SearchScheduler
+    cache: RequestCache
+    metrics: Metrics
+    # Deezer's public API allows 50 requests per 5 seconds
+    deezer_scheduler: SearchScheduler = field(
+        default_factory=lambda: SearchScheduler(max_concurrency=4, rate=9)
     )
-    # Sometimes when connecting with http, an alert dialog appears
-    try:
-        WebDriverWait(driver, 2).until(
-            EC.alert_is_present(),
-            "Timed out waiting for PA creation " + "confirmation popup to appear.",
-        )
-
-        alert = driver.switch_to.alert
-        alert.accept()
-    except TimeoutException:
-        pass
-    except NoAlertPresentException:
-        pass
+    cascade: CascadeStats = field(default_factory=CascadeStats)
 
+    async def main_search(self, search_term: str) -> list[DeezerTrack]:
+        with self.metrics.time("deemix_request_seconds", endpoint="mainSearch"):
+            async with self.session.get(
+                f"{self.deemix_url}/api/mainSearch?term={search_term}"
+            ) as resp:
+                json_data: dict[str, Any] = await resp.json()
 
-def initiate_selenium(deemix_url: str) -> WebDriver:
-    options = FirefoxOptions()
-    options.add_argument("-headless")
-    driver = WebDriver(options=options)
+        return [DeezerTrack.from_search(found) for found in json_data["TRACK"]["data"]]
 
-    driver.get(deemix_url)
-
-    try:
-        WebDriverWait(driver, 10).until(
-            EC.presence_of_element_located(
-                (
-                    By.XPATH,
-                    '//span[text()="Logged in"]',
-                )
-            )
+    async def search(self, search_terms: str) -> list[DeezerTrack]:
+        # Identical searches share one request, and repeats within the TTL none
+        search_term = urllib.parse.quote_plus(search_terms)
+        found_tracks: list[DeezerTrack] = await self.cache.get(
+            normalize_key(search_terms),
+            lambda: self.scheduler.submit(self.main_search, search_term),
         )
-    except TimeoutException as e:
-        raise click.ClickException(
-            f"Couldn't log in to Deemix, check if your ARL is up to date at {deemix_url}."
-        ) from e
-    return driver
-
-
-def sort_deemix_tracks(
-    track: dict[str, Any], found_tracks: list[Any]
-) -> list[dict[str, Any]]:
-    choices: list[dict[str, Any]] = []
-    for i, found in enumerate(found_tracks):
-        title: str = found["SNG_TITLE"]
-        title_ratio: int = fuzz.ratio(title, track["name"])  # type: ignore[reportUnknownMemberType]
-
-        artist_matches: list[Any] = []
+        return found_tracks
 
-        for artist in found["ARTISTS"]:
-            name: str = artist["ART_NAME"]
-            artist_matches.append(process.extractOne(name, track["artists"]))  # type: ignore[reportUnknownMemberType]
+    async def deezer_isrc(self, isrc: str) -> dict[str, Any]:
+        with self.metrics.time("deezer_request_seconds", endpoint="track/isrc"):
+            async with self.session.get(f"{DEEZER_API_URL}/track/isrc:{isrc}") as resp:
+                json_data: dict[str, Any] = await resp.json()
+                return json_data
 
-        artist_matches = sorted(artist_matches, key=lambda x: -x[1])
-
-        all_ratios = [title_ratio, *[match[1] for match in artist_matches]]
-        average_ratio = sum(all_ratios) / len(all_ratios)
-
-        choices.append(
-            {
-                "index": i,
-                "confidence": average_ratio,
-            }
+    async def isrc_search(self, isrc: str) -> DeezerTrack | None:
+        found: dict[str, Any] = await self.deezer_scheduler.submit(
+            self.deezer_isrc, isrc
         )
 
-    return sorted(choices, key=lambda x: -x["confidence"])
+        if "error" in found or not found.get("readable", True):
+            return None
 
-
-def find_best_match(
-    pref_file: str, found_tracks: list[Any], choices: list[dict[str, Any]]
-) -> tuple[Any, float]:
-    best_matches: list[dict[str, Any]] = []
-
-    for i, choice in enumerate(choices):
-        if i + 2 > len(choices) or choices[i + 1]["confidence"] < choice["confidence"]:
-            best_matches = choices[: i + 1]
-            break
-
-    for match in best_matches:
-        matched_track: dict[str, Any] = found_tracks[match["index"]]
-        has_flac = matched_track["FILESIZE_FLAC"]
-        has_320 = matched_track["FILESIZE_MP3_320"]
-        has_128 = matched_track["FILESIZE_MP3_128"]
-
-        if pref_file == "flac" and has_flac:
-            return matched_track, match["confidence"]
-        elif pref_file == "mp3_320" and has_320:
-            return matched_track, match["confidence"]
-        elif pref_file == "mp3_128" and has_128:
-            return matched_track, match["confidence"]
-
-    # Didn't find good match with preferred file type, return match with highest confidence
-    return found_tracks[best_matches[0]["index"]], best_matches[0]["confidence"]
+        # The formats aren't known from here
+        return DeezerTrack(
+            int(found["id"]), found["title"], intern_artists([found["artist"]["name"]])
+        )
 
 
 async def deemix_track_search(
-    session: aiohttp.ClientSession,
-    deemix_url: str,
-    track: dict[str, Any],
+    deemix: DeemixSearch,
+    track: SpotifyTrack,
+    query: Query,
     expanded: bool,
     short_title: bool = False,
-) -> tuple[list[Any], list[dict[str, Any]]]:
+) -> tuple[list[DeezerTrack], Ranking, bool]:
+    # The flag tells a failed search from one that found nothing, only
+    # the latter is a miss worth caching
     try:
         if short_title:
-            title: str = re.sub(short_title_regex, "", track["name"])
+            title: str = re.sub(short_title_regex, "", track.name)
         else:
-            title = track["name"]
+            title = track.name
 
         if expanded:
-            search_terms = " ".join([title, *track["artists"]])
+            search_terms = " ".join([title, *track.artists])
         else:
             search_terms = title
 
-        search_term = urllib.parse.quote_plus(search_terms)
+        found_tracks = await deemix.search(search_terms)
 
-        async with session.get(
-            f"{deemix_url}/api/mainSearch?term={search_term}"
-        ) as resp:
-            json_data: dict[str, Any] = await resp.json()
-            found_tracks: list[Any] = json_data["TRACK"]["data"]
+        with deemix.metrics.time("scoring_seconds"):
+            ranking = sort_deemix_tracks(query, found_tracks)
 
-            sorted_tracks = sort_deemix_tracks(track, found_tracks)
-            return found_tracks, sorted_tracks
+        return found_tracks, ranking, False
     except Exception as e:
+        deemix.metrics.inc(
+            "errors_total", stage="deemix search", error=e.__class__.__name__
+        )
         click.echo(
-            "Unable to get url {} due to {}.".format(track["name"], e.__class__),
+            f"Unable to get url {track.name} due to {e.__class__}.",
             err=True,
         )
-        return [], []
+        return [], rank_candidates(query, [], []), True
 
 
-async def find_track_on_deemix(
-    session: aiohttp.ClientSession,
-    deemix_url: str,
-    pref_file: str,
-    track: dict[str, Any],
-) -> tuple[Any, float]:
-    # Sometimes artist names confuse the Deemix search, in these cases try to search only by title
-    # Confidence threshold of 75 is an arbitrary magic number
-    found_tracks, sorted_tracks = await deemix_track_search(
-        session, deemix_url, track, expanded=True
-    )
-    if len(found_tracks) == 0 or sorted_tracks[0]["confidence"] < 75:
-        found_tracks, sorted_tracks = await deemix_track_search(
-            session, deemix_url, track, expanded=False
+async def deezer_isrc_search(
+    deemix: DeemixSearch, track: SpotifyTrack
+) -> tuple[DeezerTrack | None, bool]:
+    if track.isrc is None:
+        return None, False
+
+    try:
+        return await deemix.isrc_search(track.isrc), False
+    except Exception as e:
+        deemix.metrics.inc(
+            "errors_total", stage="deezer isrc", error=e.__class__.__name__
+        )
+        click.echo(
+            f"Unable to look up ISRC of {track.name} due to {e.__class__}.",
+            err=True,
         )
+        return None, True
 
-    # Confidence threshold of 60 is an arbitrary magic number
-    if len(found_tracks) == 0 or sorted_tracks[0]["confidence"] < 60:
-        found_tracks, sorted_tracks = await deemix_track_search(
-            session, deemix_url, track, expanded=True, short_title=True
+
+async def cascade_search(
+    deemix: DeemixSearch, track: SpotifyTrack, query: Query, variant: str
+) -> tuple[list[DeezerTrack], Ranking, bool, bool]:
+    expanded, short_title, threshold = SEARCH_CASCADE[variant]
+    deemix.cascade.attempts[variant] += 1
+
+    try:
+        found_tracks, ranking, errored = await deemix_track_search(
+            deemix, track, query, expanded, short_title
         )
+    except asyncio.CancelledError:
+        deemix.cascade.cancelled[variant] += 1
+        raise
 
-    # Confidence threshold of 60 is an arbitrary magic number
-    if len(found_tracks) == 0 or sorted_tracks[0]["confidence"] < 60:
-        return track, 0
+    if passed := ranking.best >= threshold:
+        deemix.cascade.hits[variant] += 1
 
-    return find_best_match(pref_file, found_tracks, sorted_tracks)
+    return found_tracks, ranking, passed, errored
 
 
-def add_to_deemix_cue(
-    deemix: WebDriver, deemix_url: str, track: dict[str, Any]
-) -> None:
-    data = {"bitrate": "null", "url": f"https://www.deezer.com/track/{track['SNG_ID']}"}
-    selenium_post(deemix, deemix_url, "/api/addToQueue", params=data)
+async def hedged_search(
+    deemix: DeemixSearch, track: SpotifyTrack, query: Query, delay: float
+) -> tuple[tuple[list[DeezerTrack], Ranking] | None, bool]:
+    # Risky titles start every variant at once, others give each variant a
+    # head start before the next one is sent
+    if risky_title_regex.search(track.name):
+        delay = 0
 
+    async def start(
+        index: int, variant: str
+    ) -> tuple[list[DeezerTrack], Ranking, bool, bool]:
+        await asyncio.sleep(index * delay)
+        return await cascade_search(deemix, track, query, variant)
+
+    tasks = [
+        asyncio.create_task(start(index, variant))
+        for index, variant in enumerate(SEARCH_CASCADE)
+    ]
+
+    errored = False
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            found_tracks, ranking, passed, failed = await next_done
+            if passed:
+                return (found_tracks, ranking), False
+            errored = errored or failed
+    finally:
+        for task in tasks:
+            task.cancel()
 
-async def convert_tracks_to_deezer(
-    deemix_url: str, pref_file: str, tracks: list[dict[str, Any]]
-) -> tuple[list[Any], list[Any]]:
-    best_matches: list[Any] = []
-    not_found: list[Any] = []
+    return None, errored
 
-    # Digits of total track count, for n_fmt padding
-    total_digits = str(len(str(len(tracks))))
 
-    async with aiohttp.ClientSession() as session:
-        ret: list[Any] = await tqdm_asyncio.gather(  # type: ignore[reportUnknownMemberType]
-            *(
-                find_track_on_deemix(session, deemix_url, pref_file, track)
-                for track in tracks
-            ),
+async def find_track_on_deemix(
+    deemix: DeemixSearch,
+    pref_file: str,
+    track: SpotifyTrack,
+    hedge_delay: float | None = None,
+) -> tuple[DeezerTrack | None, float, bool]:
+    query = Query(track.name, track.artists)
+
+    if hedge_delay is not None:
+        result, errored = await hedged_search(deemix, track, query, hedge_delay)
+        if result is None:
+            return None, 0, errored
+
+        found_tracks, ranking = result
+        return *find_best_match(pref_file, found_tracks, ranking), False
+
+    errored = False
+    for variant in SEARCH_CASCADE:
+        found_tracks, ranking, passed, failed = await cascade_search(
+            deemix, track, query, variant
+        )
+        if passed:
+            return *find_best_match(pref_file, found_tracks, ranking), False
+        errored = errored or failed
+
+    return None, 0, errored
+
+
+@dataclass
+class PlaylistReport:
+    name: str
+    total: int = 0
+    skipped: int = 0
+    queued: int = 0
+    not_found: list[SpotifyTrack] = field(default_factory=list)
+    # Tracks whose searches failed, they're looked up again on the next run
+    errored: list[SpotifyTrack] = field(default_factory=list)
+    unchanged: bool = False
+
+
+@dataclass
+class DeemixMirror:
+    sp: SpotifyAPI
+    deemix: DeemixSearch
+    queue: DeemixQueue
+    exit_stack: AsyncExitStack
+    pref_file: str
+    cache: MatchCache | None
+    use_isrc: bool
+    hedge_delay: float | None
+    state: PlaylistState | None = None
+    full: bool = False
+    verbose: bool = True
+    resolved_by: Counter[str] = field(default_factory=Counter)
+    # Tracks shared between playlists are resolved and queued once per run,
+    # however long the batch runs, and once per poll for watch
+    resolved: dict[str, asyncio.Task[tuple[DeezerTrack | None, float, bool]]] = field(
+        default_factory=dict
+    )
+    queued_ids: set[int] = field(default_factory=set)
+    _queue_lock: asyncio.Lock = field(default_factory=asyncio.Lock, init=False)
+    _queue_open: bool = field(default=False, init=False)
+
+    async def open_queue(self) -> None:
+        # Logging in to Deemix, or starting Firefox, waits until there's
+        # something to queue
+        async with self._queue_lock:
+            if not self._queue_open:
+                with self.sp.metrics.stage("deemix login"):
+                    await self.exit_stack.enter_async_context(self.queue)
+                self._queue_open = True
+
+    def forget(self) -> None:
+        # A long running mirror shares tracks within one pass only, so misses
+        # get searched again once the match cache lets them
+        self.resolved.clear()
+        self.queued_ids.clear()
+
+    async def resolve(
+        self, track: SpotifyTrack
+    ) -> tuple[DeezerTrack | None, float, bool]:
+        key = track_key(track)
+        if (task := self.resolved.get(key)) is None:
+            task = asyncio.create_task(self._resolve(track))
+            task.add_done_callback(partial(self._forget_failed, key))
+            self.resolved[key] = task
+
+        # Shielded, a playlist that's cancelled doesn't cancel a track
+        # another playlist waits for too
+        return await asyncio.shield(task)
+
+    def _forget_failed(
+        self, key: str, task: asyncio.Task[tuple[DeezerTrack | None, float, bool]]
+    ) -> None:
+        # Failures aren't kept, the next playlist with the track tries again
+        if task.cancelled() or task.exception() is not None or task.result()[2]:
+            self.resolved.pop(key, None)
+
+    async def _resolve(
+        self, track: SpotifyTrack
+    ) -> tuple[DeezerTrack | None, float, bool]:
+        start = time.perf_counter()
+        match, confidence, path = await self._lookup(track)
+
+        self.resolved_by[path] += 1
+        self.deemix.metrics.observe(
+            "track_resolve_seconds", time.perf_counter() - start, path=path
+        )
+        return match, confidence, path == "error"
+
+    async def _lookup(
+        self, track: SpotifyTrack
+    ) -> tuple[DeezerTrack | None, float, str]:
+        # Local files have no id to cache them under
+        spotify_id = track.id
+        cache = self.cache if spotify_id is not None else None
+
+        if cache is not None and spotify_id is not None:
+            if (cached := cache.get(spotify_id, self.pref_file)) is not None:
+                match, confidence = cached
+                return match, confidence, "cache" if confidence else "not found"
+
+        # An exact ISRC match skips the fuzzy searches and their scoring
+        match: DeezerTrack | None = None
+        isrc_errored = False
+        if self.use_isrc:
+            match, isrc_errored = await deezer_isrc_search(self.deemix, track)
+
+        if match is not None:
+            confidence = 100.0
+            path = "isrc"
+        else:
+            match, confidence, errored = await find_track_on_deemix(
+                self.deemix, self.pref_file, track, self.hedge_delay
+            )
+            if confidence:
+                path = "search"
+            elif errored or isrc_errored:
+                # Deemix being down isn't a miss, the track is searched again
+                # instead of being cached as not found for a week
+                return None, 0, "error"
+            else:
+                path = "not found"
+
+        if cache is not None and spotify_id is not None:
+            cache.put(spotify_id, match, confidence)
+
+        return match, confidence, path
+
+    def record(self, metrics: Metrics) -> None:
+        # Stats the stages keep themselves, read whenever metrics are written
+        for path, count in self.resolved_by.items():
+            metrics.inc("tracks_resolved_total", count, path=path)
+
+        self.deemix.cascade.record(metrics)
+        self.deemix.scheduler.record(metrics, "deemix search")
+        self.deemix.deezer_scheduler.record(metrics, "deezer isrc")
+        self.deemix.cache.record(metrics, "deemix search")
+        metrics.set("resolved_tracks", len(self.resolved))
+
+        if self.cache is not None:
+            self.cache.record(metrics)
+
+    async def mirror(self, playlist_id: str) -> PlaylistReport:
+        playlist_info: dict[str, Any] = await get_spotify_playlist_info(
+            self.sp, playlist_id
+        )
+        report = PlaylistReport(playlist_info["name"])
+        snapshot_id = playlist_info["snapshot_id"]
+
+        # Tracks handled by earlier runs are skipped, and so are misses until
+        # the match cache would search for them again. An unchanged snapshot
+        # with no miss due means there's nothing to read at all.
+        now = time.time()
+        negative_ttl = (
+            self.cache.negative_ttl if self.cache is not None else NEGATIVE_TTL
+        )
+        done: set[str] = set()
+        waiting: dict[str, float] = {}
+        if self.state is not None and not self.full:
+            last_snapshot, done, missed = self.state.get(playlist_id)
+            waiting = {
+                key: missed_at
+                for key, missed_at in missed.items()
+                if now - missed_at < negative_ttl
+            }
+            if last_snapshot == snapshot_id and len(waiting) == len(missed):
+                report.unchanged = True
+                return report
+
+        if self.verbose:
+            print_playlist_info(playlist_info)
+
+        # Keys still in the playlist, keys sent on, keys fully handled and
+        # keys that weren't found
+        current: set[str] = set()
+        seen: set[str] = set()
+        processed: set[str] = set()
+        not_found: set[str] = set()
+
+        # Pages, searches and queue requests overlap, the bounded queues keep
+        # a fast stage from running far ahead of a slow one
+        workers = self.deemix.scheduler.max_concurrency * 4
+        tracks: asyncio.Queue[SpotifyTrack | None] = asyncio.Queue(workers)
+        matches: asyncio.Queue[tuple[str, DeezerTrack] | None] = asyncio.Queue(workers)
+
+        found_progress = tqdm(
+            total=0,
             desc="Finding songs on Deemix",
-            bar_format="{desc}:  {percentage:3.0f}% {bar} {n:"
-            + total_digits
-            + ".0f}/{total_fmt}",
+            bar_format="{desc}:  {percentage:3.0f}% {bar} {n}/{total_fmt}",
+            ascii="⣿⣦⣀",
+            position=0,
+            disable=not self.verbose,
+        )
+        queue_progress = tqdm(
+            total=0,
+            desc="Adding to download queue",
+            bar_format="{desc}: {percentage:3.0f}% {bar} {n}/{total_fmt}",
             ascii="⣿⣦⣀",
+            position=1,
+            disable=not self.verbose,
         )
 
-    for best_match, confidence in ret:
-        if confidence == 0:
-            not_found.append(best_match)
-        else:
-            best_matches.append(best_match)
+        # Stages overlap, each one is timed from the start until it's done
+        metrics = self.sp.metrics
+
+        async def read_playlist() -> None:
+            with metrics.stage("spotify playlist"):
+                async for total, page in spotify_track_pages(self.sp, playlist_id):
+                    report.total = total
+
+                    new: list[SpotifyTrack] = []
+                    for track in page:
+                        key = track_key(track)
+                        current.add(key)
+
+                        if key in done or key in waiting or key in seen:
+                            report.skipped += 1
+                        else:
+                            seen.add(key)
+                            new.append(track)
+
+                    found_progress.total += len(new)
+                    found_progress.refresh()
+
+                    for track in new:
+                        await tracks.put(track)
+
+            for _ in range(workers):
+                await tracks.put(None)
+
+        async def find_tracks() -> None:
+            while (track := await tracks.get()) is not None:
+                match, _, errored = await self.resolve(track)
+                found_progress.update()
+
+                # Misses are kept apart from handled tracks, later runs look
+                # them up again once the match cache would search for them anew
+                if errored:
+                    report.errored.append(track)
+                elif match is None:
+                    report.not_found.append(track)
+                    not_found.add(track_key(track))
+                else:
+                    queue_progress.total += 1
+                    queue_progress.refresh()
+                    await matches.put((track_key(track), match))
+
+        async def close_matches(finders: list[asyncio.Task[None]]) -> None:
+            with metrics.stage("deemix search"):
+                await asyncio.gather(*finders)
+            await matches.put(None)
+
+        async def send_batch(
+            batch: list[tuple[str, DeezerTrack]], slots: asyncio.Semaphore
+        ) -> None:
+            try:
+                # Tracks already queued for another playlist aren't sent twice
+                fresh = [
+                    match for _, match in batch if match.sng_id not in self.queued_ids
+                ]
+                added = 0
+                if fresh:
+                    await self.open_queue()
+                    with metrics.time("deemix_queue_seconds"):
+                        added = await self.queue.add(
+                            [deezer_track_url(m) for m in fresh]
+                        )
+                    metrics.inc("tracks_queued_total", added)
+                queue_progress.update(len(batch))
+
+                # Batches fail as a whole, their tracks are tried next run
+                if added == len(fresh):
+                    self.queued_ids.update(match.sng_id for match in fresh)
+                    processed.update(key for key, _ in batch)
+                    report.queued += len(batch)
+            finally:
+                slots.release()
+
+        async def queue_matches(group: asyncio.TaskGroup) -> None:
+            with metrics.stage("deemix queue"):
+                loop = asyncio.get_running_loop()
+                done = False
+                # Batches go out while the next ones fill, as many at once as
+                # the backend takes
+                slots = asyncio.Semaphore(self.queue.concurrency)
+
+                while not done:
+                    # The first match goes out right away when matches are slow,
+                    # otherwise they're sent in batches of the backend's size
+                    received = [await matches.get()]
+                    deadline = loop.time() + QUEUE_LINGER
+
+                    while (
+                        len(received) < self.queue.batch_size
+                        and received[-1] is not None
+                    ):
+                        try:
+                            received.append(
+                                await asyncio.wait_for(
+                                    matches.get(), deadline - loop.time()
+                                )
+                            )
+                        except TimeoutError:
+                            break
+
+                    # None marks the end, it's only ever the last one received
+                    done = received[-1] is None
+                    batch = [item for item in received if item is not None]
+
+                    if batch:
+                        await slots.acquire()
+                        group.create_task(send_batch(batch, slots))
+
+                # The stage lasts until the last batch is sent
+                for _ in range(self.queue.concurrency):
+                    await slots.acquire()
+
+        try:
+            with found_progress, queue_progress:
+                async with asyncio.TaskGroup() as group:
+                    group.create_task(read_playlist())
+                    finders = [group.create_task(find_tracks()) for _ in range(workers)]
+                    group.create_task(close_matches(finders))
+                    group.create_task(queue_matches(group))
+        except* Exception as group:
+            # The other stages are only cancelled, the first failure is the cause
+            raise group.exceptions[0] from None
+
+        if self.state is not None:
+            # The snapshot is only kept when every new track was queued or
+            # isn't on Deezer, so a failed queue request or search gets another
+            # try even if nothing else changes
+            self.state.save(
+                playlist_id,
+                snapshot_id if processed | not_found == seen else None,
+                (done & current) | processed,
+                {key: at for key, at in waiting.items() if key in current}
+                | dict.fromkeys(not_found, now),
+            )
+
+        return report
+
+
+@asynccontextmanager
+async def open_mirror(
+    spotify: SpotifyClient,
+    deemix_url: str,
+    pref_file: str,
+    concurrency: int,
+    rate: float,
+    cache: MatchCache | None,
+    search_cache: RequestCache,
+    queue_backend: str,
+    arl: str | None,
+    use_isrc: bool,
+    hedge_delay: float | None,
+    state: PlaylistState | None,
+    full: bool,
+) -> AsyncGenerator[DeemixMirror]:
+    async with (
+        spotify.api() as sp,
+        aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=concurrency)
+        ) as session,
+        AsyncExitStack() as exit_stack,
+    ):
+        scheduler = SearchScheduler(max_concurrency=concurrency, rate=rate)
+        mirror = DeemixMirror(
+            sp,
+            DeemixSearch(session, deemix_url, scheduler, search_cache, sp.metrics),
+            open_queue(queue_backend, deemix_url, arl),
+            exit_stack,
+            pref_file,
+            cache,
+            use_isrc,
+            hedge_delay,
+            state,
+            full,
+        )
+
+        sp.metrics.add_collector(mirror.record)
+        yield mirror
 
-    return best_matches, not_found
 
+def print_report(report: PlaylistReport, header: bool) -> None:
+    if header:
+        click.secho(f"\n{report.name}", fg="blue", nl=False)
+        click.echo(":", nl=False)
 
-def deemix_tracks_to_cue(deemix_url: str, deezer_matches: list[Any]) -> None:
-    driver = initiate_selenium(deemix_url)
+    if report.unchanged:
+        if not header:
+            click.secho(f"\n{report.name}", fg="blue", nl=False)
+        click.echo(" hasn't changed since the last run.")
+        return
 
-    # Digits of total track count, for n_fmt padding
-    total_digits = str(len(str(len(deezer_matches))))
+    if report.skipped > 0:
+        click.echo(f"\nSkipped {report.skipped} tracks handled on earlier runs.")
+
+    click.secho(
+        f"\n{report.queued}/{report.total - report.skipped}", fg="green", nl=False
+    )
+    click.echo(" tracks downloaded.\n")
 
-    for match in tqdm(
-        deezer_matches,
-        desc="Adding to download queue",
-        bar_format="{desc}: {percentage:3.0f}% {bar} {n:"
-        + total_digits
-        + ".0f}/{total_fmt}",
-        ascii="⣿⣦⣀",
+    for tracks, heading in (
+        (report.not_found, "These songs couldn't be found:"),
+        (report.errored, "These songs couldn't be searched for, try again later:"),
     ):
-        add_to_deemix_cue(driver, deemix_url, match)
-        sleep(0.5)
+        if len(tracks) == 0:
+            continue
 
-    driver.quit()
+        click.secho(heading, fg="red")
 
+        for track in tracks:
+            click.secho(f"{track.name}", fg="blue", nl=False)
 
-async def parse_playlist(sp: Any, playlist_id: str) -> list[dict[str, Any]]:
-    track_ids = get_spotify_track_ids(sp, playlist_id)
-    tracks = await get_spotify_track_info(sp, track_ids)
-    return tracks
+            click.echo(" - ", nl=False)
+            click.secho(f"{', '.join(track.artists)}", fg="magenta")
 
 
-def main(
-    client_id: str,
-    client_secret: str,
-    deemix_url: str,
-    pref_file: str,
-    playlist_link: str,
-) -> None:
-    sp: Any = spotipy.Spotify(
-        client_credentials_manager=SpotifyClientCredentials(
-            client_id=client_id, client_secret=client_secret
+def print_stats(mirror: DeemixMirror) -> None:
+    if not mirror.resolved_by:
+        return
+
+    click.echo("\nTracks resolved by ", nl=False)
+    click.echo(
+        ", ".join(f"{path}: {count}" for path, count in mirror.resolved_by.items())
+    )
+
+    cascade = mirror.deemix.cascade
+    click.echo("Search variants hit ", nl=False)
+    click.echo(
+        ", ".join(
+            f"{variant}: {cascade.hits[variant]}/{attempts}"
+            + (
+                f" ({cascade.cancelled[variant]} cancelled)"
+                if mirror.hedge_delay is not None
+                else ""
+            )
+            for variant, attempts in cascade.attempts.items()
         )
     )
 
-    playlist_id = get_spotify_playlist_id(playlist_link)
-    get_spotify_playlist_info(sp, playlist_id)
+    search_cache = mirror.deemix.cache
+    click.echo(f"Deemix searches: {search_cache.requests} lookups,", nl=False)
+    click.echo(f" {search_cache.saved} without an HTTP call", nl=False)
+    click.echo(f" ({search_cache.hits} cached, {search_cache.coalesced} shared).")
 
-    tracks = asyncio.run(parse_playlist(sp, playlist_id))
+    if (cache := mirror.cache) is not None:
+        click.echo(f"Match cache: {cache.hits} hits, {cache.misses} misses", nl=False)
+        click.echo(f" ({cache.expired} expired, {cache.evicted} evicted).")
 
-    deezer_matches, no_matches = asyncio.run(
-        convert_tracks_to_deezer(deemix_url, pref_file, tracks)
+    requests = mirror.sp.metrics.count("spotify_requests_total", "endpoint")
+    click.echo(f"Spotify requests: {requests.total()} (", nl=False)
+    click.echo(
+        ", ".join(f"{name}: {count}" for name, count in requests.most_common()),
+        nl=False,
     )
-    deemix_tracks_to_cue(deemix_url, deezer_matches)
+    click.echo(").")
 
-    click.secho(f"\n{len(deezer_matches)}/{len(tracks)}", fg="green", nl=False)
-    click.echo(" tracks downloaded.\n")
-
-    if len(no_matches) > 0:
-        click.secho("These songs couldn't be found:", fg="red")
 
-        for track in no_matches:
-            click.secho(f"{track['name']}", fg="blue", nl=False)
+def main(
+    spotify: SpotifyClient,
+    deemix_url: str,
+    pref_file: str,
+    playlist_links: list[str],
+    concurrency: int,
+    rate: float,
+    use_cache: bool,
+    refresh: bool,
+    queue_backend: str,
+    arl: str | None,
+    use_isrc: bool,
+    hedge_delay: float | None,
+    full: bool,
+) -> None:
+    # A bad line in --from-file only skips that line
+    playlist_ids: list[str] = []
+    skipped = 0
+    for link in playlist_links:
+        try:
+            playlist_ids.append(get_spotify_playlist_id(link))
+        except click.BadParameter:
+            click.echo(f"Skipping {link}, it isn't a Spotify playlist URL.", err=True)
+            skipped += 1
+
+    if len(playlist_ids) == 0:
+        raise click.UsageError("None of the given URLs is a Spotify playlist.")
+
+    # The same playlist listed twice is only mirrored once
+    playlist_ids = list(dict.fromkeys(playlist_ids))
+
+    cache = MatchCache(read=not refresh) if use_cache else None
+    search_cache = RequestCache()
+    state = PlaylistState(deemix_url, pref_file)
+
+    # Skipping tracks earlier runs handled would skip exactly the searches
+    # these options ask to do again
+    full = full or refresh or not use_cache
+
+    # Playlists that failed as a whole
+    failed = 0
+
+    async def run() -> tuple[list[PlaylistReport], DeemixMirror]:
+        nonlocal failed
+        reports: list[PlaylistReport] = []
+
+        async with open_mirror(
+            spotify,
+            deemix_url,
+            pref_file,
+            concurrency,
+            rate,
+            cache,
+            search_cache,
+            queue_backend,
+            arl,
+            use_isrc,
+            hedge_delay,
+            state,
+            full,
+        ) as mirror:
+            for playlist_id in playlist_ids:
+                # One broken playlist doesn't stop the rest of the batch
+                try:
+                    reports.append(await mirror.mirror(playlist_id))
+                except click.ClickException as e:
+                    click.echo(
+                        f"Unable to download {playlist_id}: {e.format_message()}",
+                        err=True,
+                    )
+                    failed += 1
+                except (aiohttp.ClientError, TimeoutError) as e:
+                    # Deemix refusing a queue request, or going away mid-batch
+                    click.echo(
+                        f"Unable to download {playlist_id} due to {e.__class__}.",
+                        err=True,
+                    )
+                    failed += 1
+
+            return reports, mirror
 
-            click.echo(" - ", nl=False)
-            click.secho(f"{', '.join(track['artists'])}", fg="magenta")
+    try:
+        reports, mirror = asyncio.run(run())
+    finally:
+        state.close()
+        if cache is not None:
+            cache.close()
+
+    for report in reports:
+        print_report(report, header=len(playlist_ids) > 1)
+
+    if len(playlist_ids) > 1:
+        queued = sum(report.queued for report in reports)
+        click.secho(f"\n{queued}", fg="green", nl=False)
+        click.echo(f" tracks downloaded from {len(reports)} playlists,", nl=False)
+        click.echo(f" {len(mirror.queued_ids)} unique.")
+
+    print_stats(mirror)
+
+    # Scheduled runs only see the exit code, a partial batch isn't a success
+    failed += sum(1 for report in reports if report.errored)
+    problems: list[str] = []
+    if failed:
+        problems.append(
+            f"{failed} of {len(playlist_ids)} playlists weren't fully downloaded"
+        )
+    if skipped:
+        problems.append(f"{skipped} URLs weren't Spotify playlists")
+    if problems:
+        raise click.ClickException(", ".join(problems) + ".")
@@ -1,10 +1,61 @@
+from typing import TYPE_CHECKING, Any
+
 import click
 
+from spoteemix.config_helper import load_configs
+from spoteemix.helpers.metrics import Metrics
+
+if TYPE_CHECKING:
+    from spoteemix.helpers.spotify_api import SpotifyAPI
+
+
+class ConfigGroup(click.Group):
+    def make_context(
+        self,
+        info_name: str | None,
+        args: list[str],
+        parent: click.Context | None = None,
+        **extra: Any,
+    ) -> click.Context:
+        # The config is read when the CLI runs, importing it stays side effect free
+        extra.setdefault("default_map", load_configs())
+        return super().make_context(info_name, args, parent, **extra)
+
 
 class SpotifyClient:
     def __init__(self, id: str, secret: str) -> None:
         self.id = id
         self.secret = secret
 
+        # Requests, timings and stage stats over every client made from this one
+        self.metrics = Metrics()
+
+    def api(self, max_connections: int = 10) -> SpotifyAPI:
+        # Imported here so the CLI starts without aiohttp and spotipy
+        from spoteemix.helpers.spotify_api import (
+            ClientCredentials,
+            SpotifyAPI,
+            default_token_path,
+        )
+
+        # The app token is kept on disk until it expires, later runs skip
+        # logging in again
+        auth = ClientCredentials(
+            self.id, self.secret, default_token_path(self.id, "app")
+        )
+        return SpotifyAPI(auth, max_connections, metrics=self.metrics)
+
+    def user(self, api: SpotifyAPI, scope: str) -> SpotifyAPI:
+        from spoteemix.helpers.spotify_api import (
+            UserAuthorization,
+            default_token_path,
+        )
+
+        # Shares the connection pool of the app client it's made from
+        auth = UserAuthorization(
+            self.id, self.secret, scope, default_token_path(self.id, "user")
+        )
+        return api.authorize(auth)
+
 
 pass_spotify = click.make_pass_decorator(SpotifyClient)
@@ -0,0 +1,221 @@
+import json
+import os
+import sqlite3
+import time
+from collections.abc import Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Any
+
+import click
+
+from spoteemix.config_helper import APP_NAME
+from spoteemix.helpers.tracks import LocalTrack, intern_artists
+
+# Tags are read with mutagen when it's installed (the "tags" extra),
+# otherwise the file names have to follow the "Artist - Title" convention
+try:
+    import mutagen
+except ImportError:
+    mutagen = None
+
+# How tracks are read, entries read another way are read again
+READER = "tags" if mutagen is not None else "name"
+
+AUDIO_SUFFIXES = {
+    ".aiff",
+    ".ape",
+    ".flac",
+    ".m4a",
+    ".mp3",
+    ".mp4",
+    ".ogg",
+    ".opus",
+    ".wav",
+    ".wma",
+    ".wv",
+}
+
+
+def default_index_path() -> Path:
+    return Path(click.get_app_dir(APP_NAME)) / "library.sqlite3"
+
+
+class LibraryIndex:
+    def __init__(self, path: Path | None = None) -> None:
+        path = path or default_index_path()
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Scans may run in a worker thread, one at a time
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                title TEXT NOT NULL,
+                artists TEXT NOT NULL,
+                reader TEXT NOT NULL,
+                scanned_at REAL NOT NULL
+            )
+            """
+        )
+
+    def get(self, path: str, mtime_ns: int, size: int) -> LocalTrack | None:
+        row = self._db.execute(
+            "SELECT title, artists FROM files"
+            " WHERE path = ? AND mtime_ns = ? AND size = ? AND reader = ?",
+            (path, mtime_ns, size, READER),
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        return LocalTrack(row[0], intern_artists(json.loads(row[1])), path)
+
+    def put(
+        self, path: str, mtime_ns: int, size: int, track: LocalTrack, now: float
+    ) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                path,
+                mtime_ns,
+                size,
+                track.title,
+                json.dumps(track.artists),
+                READER,
+                now,
+            ),
+        )
+
+    def touch(self, paths: list[str], now: float) -> None:
+        self._db.executemany(
+            "UPDATE files SET scanned_at = ? WHERE path = ?",
+            ((now, path) for path in paths),
+        )
+
+    def prune(self, root: Path, scan_started: float) -> None:
+        # Files under the scanned folder that weren't seen are gone
+        prefix = os.path.join(root, "")
+        self._db.execute(
+            "DELETE FROM files WHERE substr(path, 1, ?) = ? AND scanned_at < ?",
+            (len(prefix), prefix, scan_started),
+        )
+
+    def close(self) -> None:
+        self._db.commit()
+        self._db.close()
+
+
+def filename_track(path: str) -> LocalTrack:
+    track_info = Path(path).stem
+    try:
+        artist, title = track_info.split(" - ", 1)
+        return LocalTrack(title, intern_artists([artist]), path)
+    except ValueError:
+        return LocalTrack(track_info, (), path)
+
+
+def read_track(path: str) -> LocalTrack:
+    if mutagen is None:
+        return filename_track(path)
+
+    try:
+        # Easy tags give ID3, Vorbis comments and MP4 atoms the same keys,
+        # mutagen wraps its IO errors in MutagenError
+        audio: Any = mutagen.File(path, easy=True)  # type: ignore[reportUnknownMemberType]
+    except mutagen.MutagenError:
+        audio = None
+
+    tags: Any = audio.tags if audio is not None else None
+    titles: list[str] = tags.get("title", []) if tags is not None else []
+    if not titles:
+        click.echo(f"No title tag in {path}, using its file name.", err=True)
+        return filename_track(path)
+
+    artists: list[str] = tags.get("artist", [])
+    return LocalTrack(titles[0], intern_artists(artists), path)
+
+
+def list_directory(path: str) -> tuple[list[str], list[tuple[str, int, int]]]:
+    directories: list[str] = []
+    files: list[tuple[str, int, int]] = []
+
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+
+                # Symlinked folders could loop back into the library
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif os.path.splitext(entry.name)[1].lower() in AUDIO_SUFFIXES:
+                    stat = entry.stat()
+                    files.append((entry.path, stat.st_mtime_ns, stat.st_size))
+    except OSError as e:
+        click.echo(f"Unable to read {path} due to {e.__class__}.", err=True)
+
+    return directories, files
+
+
+def scan_library(
+    root: Path, index: LibraryIndex | None = None, workers: int = 8
+) -> Iterator[LocalTrack]:
+    scan_started = time.time()
+    root = root.resolve()
+
+    if mutagen is None:
+        click.echo(
+            "mutagen isn't installed, tracks are read from their file names.",
+            err=True,
+        )
+
+    # Folder listings and tag reads share the pool, tracks are yielded as
+    # soon as they're known instead of after the whole walk. Listings are
+    # keyed by None, tag reads by the file they read.
+    pool = ThreadPoolExecutor(workers)
+    pending: dict[Future[Any], tuple[str, int, int] | None] = {
+        pool.submit(list_directory, str(root)): None
+    }
+
+    try:
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if (file := pending.pop(future)) is not None:
+                    path, mtime_ns, size = file
+                    track: LocalTrack = future.result()
+
+                    if index is not None:
+                        index.put(path, mtime_ns, size, track, scan_started)
+
+                    yield track
+                    continue
+
+                directories, files = future.result()
+                for directory in directories:
+                    pending[pool.submit(list_directory, directory)] = None
+
+                unchanged: list[str] = []
+                for path, mtime_ns, size in files:
+                    # Only new and changed files are opened again
+                    if index is not None and (
+                        cached := index.get(path, mtime_ns, size)
+                    ):
+                        unchanged.append(path)
+                        yield cached
+                    else:
+                        pending[pool.submit(read_track, path)] = (path, mtime_ns, size)
+
+                if index is not None:
+                    index.touch(unchanged, scan_started)
+    finally:
+        # A consumer that stops early doesn't wait for the rest of the walk
+        pool.shutdown(cancel_futures=True)
+
+    if index is not None:
+        index.prune(root, scan_started)
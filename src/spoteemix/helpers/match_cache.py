@@ -0,0 +1,150 @@
+import sqlite3
+import time
+from pathlib import Path
+
+import click
+
+from spoteemix.config_helper import APP_NAME
+from spoteemix.helpers.metrics import Metrics
+from spoteemix.helpers.tracks import DeezerTrack
+
+# Not found results are searched again after a week, catalogs change
+NEGATIVE_TTL = 7 * 24 * 60 * 60
+MAX_ENTRIES = 100_000
+
+
+def default_cache_path() -> Path:
+    return Path(click.get_app_dir(APP_NAME)) / "matches.sqlite3"
+
+
+class MatchCache:
+    def __init__(
+        self,
+        path: Path | None = None,
+        read: bool = True,
+        max_entries: int = MAX_ENTRIES,
+        negative_ttl: float = NEGATIVE_TTL,
+    ) -> None:
+        path = path or default_cache_path()
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Refreshing skips the lookups but still stores the new results
+        self.read = read
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS matches (
+                spotify_id TEXT PRIMARY KEY,
+                sng_id TEXT,
+                title TEXT,
+                confidence REAL NOT NULL,
+                formats TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS matches_accessed ON matches (accessed_at)"
+        )
+
+    def get(
+        self, spotify_id: str, pref_file: str
+    ) -> tuple[DeezerTrack | None, float] | None:
+        if not self.read:
+            self.misses += 1
+            return None
+
+        row = self._db.execute(
+            "SELECT sng_id, title, confidence, formats, updated_at"
+            " FROM matches WHERE spotify_id = ?",
+            (spotify_id,),
+        ).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        sng_id, title, confidence, formats, updated_at = row
+        now = time.time()
+
+        if sng_id is None and now - updated_at > self.negative_ttl:
+            self.expired += 1
+            self.misses += 1
+            return None
+
+        # A run with another preferred format might find a better file,
+        # ISRC matches don't know their formats and are always reused
+        if sng_id and formats and pref_file not in formats.split(","):
+            self.misses += 1
+            return None
+
+        self._db.execute(
+            "UPDATE matches SET accessed_at = ? WHERE spotify_id = ?",
+            (now, spotify_id),
+        )
+        self.hits += 1
+
+        if sng_id is None:
+            return None, 0
+
+        # Cached matches only carry what queueing and reporting need
+        return (
+            DeezerTrack(
+                int(sng_id), title, (), tuple(formats.split(",") if formats else ())
+            ),
+            confidence,
+        )
+
+    def put(
+        self,
+        spotify_id: str,
+        match: DeezerTrack | None,
+        confidence: float,
+    ) -> None:
+        now = time.time()
+        self._db.execute(
+            "INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                spotify_id,
+                str(match.sng_id) if match else None,
+                match.title if match else None,
+                confidence,
+                ",".join(match.formats) if match else "",
+                now,
+                now,
+            ),
+        )
+
+    def record(self, metrics: Metrics) -> None:
+        metrics.inc("match_cache_hits_total", self.hits)
+        metrics.inc("match_cache_misses_total", self.misses)
+        metrics.inc("match_cache_expired_total", self.expired)
+        metrics.inc("match_cache_evicted_total", self.evicted)
+
+    def evict(self) -> None:
+        (count,) = self._db.execute("SELECT COUNT(*) FROM matches").fetchone()
+
+        if (overflow := count - self.max_entries) > 0:
+            self._db.execute(
+                "DELETE FROM matches WHERE spotify_id IN"
+                " (SELECT spotify_id FROM matches ORDER BY accessed_at LIMIT ?)",
+                (overflow,),
+            )
+            self.evicted += overflow
+
+    def commit(self) -> None:
+        self.evict()
+        self._db.commit()
+
+    def close(self) -> None:
+        self.commit()
+        self._db.close()
@@ -0,0 +1,248 @@
+import json
+import math
+import os
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from collections.abc import Callable, Generator
+from contextlib import AbstractContextManager, contextmanager
+from dataclasses import dataclass, field
+from datetime import UTC, datetime
+from pathlib import Path
+from typing import Any
+
+import click
+
+# Seconds, from a cached lookup up to a request that waited out a rate limit
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Seconds, whole stages of a run take a lot longer than single requests
+STAGE_BUCKETS = (0.1, 1, 5, 15, 60, 300, 900, 3600)
+
+PROMETHEUS_PREFIX = "spoteemix_"
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def label_key(labels: dict[str, object]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+@dataclass(slots=True)
+class Histogram:
+    buckets: tuple[float, ...]
+    # One count per bucket, the last one for values above every bucket
+    counts: list[int]
+    count: int = 0
+    sum: float = 0.0
+    max: float = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        # Interpolated within the bucket, the same estimate Prometheus makes
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+
+        for upper, count in zip((*self.buckets, self.max), self.counts, strict=True):
+            if count and seen + count >= rank:
+                return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+            lower = upper
+
+        return self.max
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+        total = 0
+        counts: list[tuple[str, int]] = []
+        for bound, count in zip(bounds, self.counts, strict=True):
+            total += count
+            counts.append((bound, total))
+        return counts
+
+
+@dataclass
+class Metrics:
+    counters: defaultdict[str, dict[Labels, float]] = field(
+        default_factory=lambda: defaultdict(dict)
+    )
+    gauges: defaultdict[str, dict[Labels, float]] = field(
+        default_factory=lambda: defaultdict(dict)
+    )
+    histograms: defaultdict[str, dict[Labels, Histogram]] = field(
+        default_factory=lambda: defaultdict(dict)
+    )
+    # Stats kept elsewhere, like cache hits, are read when a report is made
+    collectors: list[Callable[[Metrics], None]] = field(default_factory=list)
+    json_path: Path | None = None
+    prometheus_path: Path | None = None
+    started_at: float = field(default_factory=time.time)
+    _started: float = field(default_factory=time.monotonic)
+
+    def inc(self, name: str, value: float = 1, **labels: object) -> None:
+        counter = self.counters[name]
+        key = label_key(labels)
+        counter[key] = counter.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: object) -> None:
+        self.gauges[name][label_key(labels)] = value
+
+    def observe(
+        self,
+        name: str,
+        value: float,
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+        **labels: object,
+    ) -> None:
+        key = label_key(labels)
+        if (histogram := self.histograms[name].get(key)) is None:
+            histogram = Histogram(buckets, [0] * (len(buckets) + 1))
+            self.histograms[name][key] = histogram
+
+        histogram.observe(value)
+
+    @contextmanager
+    def time(
+        self,
+        name: str,
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+        **labels: object,
+    ) -> Generator[None]:
+        # Failed and cancelled calls are timed too, they took the time as well
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, buckets, **labels)
+
+    def stage(self, name: str) -> AbstractContextManager[None]:
+        return self.time("stage_seconds", STAGE_BUCKETS, stage=name)
+
+    def add_collector(self, collector: Callable[[Metrics], None]) -> None:
+        self.collectors.append(collector)
+
+    def count(self, name: str, label: str) -> Counter[str]:
+        # Totals by one label, summed over the others
+        totals: Counter[str] = Counter()
+        for labels, value in self.counters[name].items():
+            totals[dict(labels)[label]] += int(value)
+        return totals
+
+    def snapshot(self) -> Metrics:
+        # Collectors add to a copy, so reporting twice doesn't count twice
+        snapshot = Metrics(
+            defaultdict(dict, {name: dict(c) for name, c in self.counters.items()}),
+            defaultdict(dict, {name: dict(g) for name, g in self.gauges.items()}),
+            self.histograms,
+            started_at=self.started_at,
+            _started=self._started,
+        )
+        for collector in self.collectors:
+            collector(snapshot)
+        return snapshot
+
+    def report(self) -> dict[str, Any]:
+        snapshot = self.snapshot()
+
+        def series(values: dict[Labels, float]) -> list[dict[str, Any]]:
+            return [
+                {"labels": dict(labels), "value": value}
+                for labels, value in sorted(values.items())
+            ]
+
+        return {
+            "started_at": datetime.fromtimestamp(self.started_at, UTC).isoformat(),
+            "wall_seconds": round(time.monotonic() - self._started, 3),
+            "counters": {
+                name: series(values)
+                for name, values in sorted(snapshot.counters.items())
+            },
+            "gauges": {
+                name: series(values) for name, values in sorted(snapshot.gauges.items())
+            },
+            "histograms": {
+                name: [
+                    {
+                        "labels": dict(labels),
+                        "count": histogram.count,
+                        "sum": round(histogram.sum, 6),
+                        "mean": round(histogram.sum / histogram.count, 6),
+                        "p50": round(histogram.quantile(0.5), 6),
+                        "p95": round(histogram.quantile(0.95), 6),
+                        "p99": round(histogram.quantile(0.99), 6),
+                        "max": round(histogram.max, 6),
+                        "buckets": dict(histogram.cumulative()),
+                    }
+                    for labels, histogram in sorted(values.items())
+                ]
+                for name, values in sorted(snapshot.histograms.items())
+            },
+        }
+
+    def prometheus(self) -> str:
+        snapshot = self.snapshot()
+        lines: list[str] = []
+
+        def sample(name: str, labels: Labels, value: float) -> None:
+            text = ",".join(f'{key}="{escape(label)}"' for key, label in labels)
+            if text:
+                name = f"{name}{{{text}}}"
+            lines.append(f"{name} {format_value(value)}")
+
+        for kind, metrics in (
+            ("counter", snapshot.counters),
+            ("gauge", snapshot.gauges),
+        ):
+            for name, values in sorted(metrics.items()):
+                name = PROMETHEUS_PREFIX + name
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in sorted(values.items()):
+                    sample(name, labels, value)
+
+        for name, values in sorted(snapshot.histograms.items()):
+            name = PROMETHEUS_PREFIX + name
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in sorted(values.items()):
+                for bound, count in histogram.cumulative():
+                    sample(f"{name}_bucket", (*labels, ("le", bound)), count)
+                sample(f"{name}_sum", labels, histogram.sum)
+                sample(f"{name}_count", labels, histogram.count)
+
+        return "\n".join(lines) + "\n"
+
+    def write(self) -> None:
+        # Replaced whole, a scraper never reads a file halfway written
+        outputs: list[tuple[Path | None, Callable[[], str]]] = [
+            (self.json_path, lambda: json.dumps(self.report(), indent=2) + "\n"),
+            (self.prometheus_path, self.prometheus),
+        ]
+
+        for path, render in outputs:
+            if path is None:
+                continue
+
+            try:
+                tmp_path = path.with_name(f".{path.name}.tmp")
+                tmp_path.write_text(render())
+                os.replace(tmp_path, path)
+            except OSError as e:
+                click.echo(
+                    f"Unable to write metrics to {path} due to {e.__class__}.",
+                    err=True,
+                )
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    # Whole numbers are written without exponent, even when they're floats
+    return str(int(value)) if float(value).is_integer() else repr(value)
@@ -0,0 +1,59 @@
+import asyncio
+from collections import deque
+from collections.abc import AsyncGenerator, Awaitable, Callable
+from typing import Any
+
+# Largest page every listing endpoint we page through accepts
+PAGE_SIZE = 50
+PAGE_CONCURRENCY = 4
+
+
+async def paginate(
+    fetch: Callable[..., Awaitable[Any]],
+    offset: int = 0,
+    total: int | None = None,
+    limit: int = PAGE_SIZE,
+    concurrency: int = PAGE_CONCURRENCY,
+) -> AsyncGenerator[tuple[int, list[Any]]]:
+    # Pages come back in order as (total, items). Until the total is known
+    # only the first page is fetched, after that a window of the following
+    # pages is in flight at once.
+    pending: deque[tuple[int, asyncio.Task[Any]]] = deque()
+    planned = offset
+
+    try:
+        while True:
+            while len(pending) < concurrency and (
+                (total is None and not pending)
+                or (total is not None and planned < total)
+            ):
+                task = asyncio.ensure_future(fetch(offset=planned, limit=limit))
+                pending.append((planned, task))
+                planned += limit
+
+            if not pending:
+                break
+
+            page_offset, task = pending.popleft()
+            response: dict[str, Any] = await task
+            items: list[Any] = response["items"]
+
+            if len(items) == 0:
+                break
+
+            # Each page reports the current size, a playlist edited during
+            # the scan grows or shrinks what's left to fetch
+            total = int(response["total"])
+            yield total, items
+
+            # A short page before the end means items moved, the pages
+            # already in flight would skip some, so continue right after it
+            end = page_offset + len(items)
+            if len(items) < limit and end < total:
+                for _, task in pending:
+                    task.cancel()
+                pending.clear()
+                planned = end
+    finally:
+        for _, task in pending:
+            task.cancel()
@@ -0,0 +1,102 @@
+import sqlite3
+import time
+from collections.abc import Iterable
+from pathlib import Path
+
+import click
+
+from spoteemix.config_helper import APP_NAME
+
+
+def default_state_path() -> Path:
+    return Path(click.get_app_dir(APP_NAME)) / "playlists.sqlite3"
+
+
+class PlaylistState:
+    def __init__(
+        self, deemix_url: str, pref_file: str, path: Path | None = None
+    ) -> None:
+        path = path or default_state_path()
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Progress only counts for the Deemix it was queued to and the format
+        # it was matched for, another target starts the playlist over
+        self.target = (deemix_url.rstrip("/"), pref_file)
+
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS synced_playlists (
+                playlist_id TEXT NOT NULL,
+                deemix_url TEXT NOT NULL,
+                format TEXT NOT NULL,
+                snapshot_id TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (playlist_id, deemix_url, format)
+            )
+            """
+        )
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS synced_tracks (
+                playlist_id TEXT NOT NULL,
+                deemix_url TEXT NOT NULL,
+                format TEXT NOT NULL,
+                track_key TEXT NOT NULL,
+                missed_at REAL,
+                PRIMARY KEY (playlist_id, deemix_url, format, track_key)
+            ) WITHOUT ROWID
+            """
+        )
+
+    def get(self, playlist_id: str) -> tuple[str | None, set[str], dict[str, float]]:
+        # Tracks that were queued, and tracks that weren't found with when
+        row = self._db.execute(
+            "SELECT snapshot_id FROM synced_playlists"
+            " WHERE playlist_id = ? AND deemix_url = ? AND format = ?",
+            (playlist_id, *self.target),
+        ).fetchone()
+
+        if row is None:
+            return None, set(), {}
+
+        keys: set[str] = set()
+        missed: dict[str, float] = {}
+        for key, missed_at in self._db.execute(
+            "SELECT track_key, missed_at FROM synced_tracks"
+            " WHERE playlist_id = ? AND deemix_url = ? AND format = ?",
+            (playlist_id, *self.target),
+        ):
+            if missed_at is None:
+                keys.add(key)
+            else:
+                missed[key] = missed_at
+
+        return row[0], keys, missed
+
+    def save(
+        self,
+        playlist_id: str,
+        snapshot_id: str | None,
+        keys: Iterable[str],
+        missed: dict[str, float],
+    ) -> None:
+        # Committed right away, an interrupted batch keeps the playlists it finished
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO synced_playlists VALUES (?, ?, ?, ?, ?)",
+                (playlist_id, *self.target, snapshot_id, time.time()),
+            )
+            self._db.execute(
+                "DELETE FROM synced_tracks"
+                " WHERE playlist_id = ? AND deemix_url = ? AND format = ?",
+                (playlist_id, *self.target),
+            )
+            self._db.executemany(
+                "INSERT INTO synced_tracks VALUES (?, ?, ?, ?, ?)",
+                [(playlist_id, *self.target, key, None) for key in keys]
+                + [(playlist_id, *self.target, key, at) for key, at in missed.items()],
+            )
+
+    def close(self) -> None:
+        self._db.close()
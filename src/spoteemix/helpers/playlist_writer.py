@@ -0,0 +1,104 @@
+import asyncio
+from functools import partial
+
+from tqdm.auto import tqdm
+
+from spoteemix.helpers.pagination import paginate
+from spoteemix.helpers.spotify_api import SpotifyAPI, SpotifyAPIError
+
+# Most items one add or replace request takes
+MAX_ITEMS = 100
+MAX_ATTEMPTS = 3
+
+
+def retryable(e: SpotifyAPIError) -> bool:
+    # Rejected requests fail the same way when sent again, the client gives
+    # up on the others only after its own retries
+    return e.status == 0 or e.status == 429 or e.status >= 500
+
+
+async def playlist_uris(sp: SpotifyAPI, playlist_id: str) -> list[str]:
+    uris: list[str] = []
+
+    async for _, items in paginate(
+        partial(sp.playlist_items, playlist_id, fields="items(item(uri)),total")
+    ):
+        # Unavailable items keep their place, but never match a target uri
+        uris.extend(item["item"]["uri"] if item["item"] else "" for item in items)
+
+    return uris
+
+
+async def playlist_length(sp: SpotifyAPI, playlist_id: str) -> int:
+    response = await sp.playlist_items(playlist_id, limit=1, fields="total")
+    return int(response["total"])
+
+
+async def append_chunk(
+    sp: SpotifyAPI, playlist_id: str, chunk: list[str], length: int
+) -> str:
+    attempts = 0
+
+    while True:
+        try:
+            response = await sp.playlist_add_items(playlist_id, chunk)
+            return str(response["snapshot_id"])
+        except SpotifyAPIError as e:
+            attempts += 1
+            if not retryable(e) or attempts == MAX_ATTEMPTS:
+                raise
+
+            # A request that timed out may have been applied anyway, sending
+            # it again would add the chunk twice
+            await asyncio.sleep(2**attempts)
+            current = await playlist_length(sp, playlist_id)
+            if current == length + len(chunk):
+                playlist = await sp.playlist(playlist_id, fields="snapshot_id")
+                return str(playlist["snapshot_id"])
+
+            if current != length:
+                raise SpotifyAPIError(
+                    409, "playlist changed while its tracks were being added"
+                ) from e
+
+
+async def write_playlist(
+    sp: SpotifyAPI,
+    playlist_id: str,
+    uris: list[str],
+    existing: list[str] | None = None,
+) -> str | None:
+    if existing is None:
+        existing = await playlist_uris(sp, playlist_id)
+
+    snapshot_id: str | None = None
+
+    # A playlist that already starts with the target, like after an
+    # interrupted write, is continued instead of written again
+    if existing == uris[: len(existing)]:
+        written = len(existing)
+    else:
+        response = await sp.playlist_replace_items(playlist_id, uris[:MAX_ITEMS])
+        snapshot_id = response["snapshot_id"]
+        written = min(len(uris), MAX_ITEMS)
+
+    # Digits of total track count, for n_fmt padding
+    total_digits = str(len(str(len(uris))))
+
+    # Appends go one chunk at a time, the API has no way to keep the order
+    # of concurrent ones
+    with tqdm(
+        total=len(uris),
+        initial=written,
+        desc="Adding tracks to playlist",
+        bar_format="{desc}: {percentage:3.0f}% {bar} {n:"
+        + total_digits
+        + ".0f}/{total_fmt}",
+        ascii="⣿⣦⣀",
+    ) as progress:
+        for start in range(written, len(uris), MAX_ITEMS):
+            chunk = uris[start : start + MAX_ITEMS]
+            snapshot_id = await append_chunk(sp, playlist_id, chunk, start)
+            progress.update(len(chunk))
+
+    return snapshot_id
@@ -0,0 +1,80 @@
+import asyncio
+import time
+from collections import Counter, OrderedDict
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from spoteemix.helpers.metrics import Metrics
+
+
+def normalize_key(term: str) -> str:
+    return " ".join(term.casefold().split())
+
+
+class RequestCache:
+    def __init__(self, max_entries: int = 10_000, ttl: float = 15 * 60) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self.requests = 0
+        self.hits = 0
+        self.coalesced = 0
+
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._in_flight: dict[str, asyncio.Future[Any]] = {}
+        self._waiters: Counter[str] = Counter()
+
+    @property
+    def saved(self) -> int:
+        return self.hits + self.coalesced
+
+    def record(self, metrics: Metrics, name: str) -> None:
+        metrics.inc("request_cache_lookups_total", self.requests, cache=name)
+        metrics.inc("request_cache_hits_total", self.hits, cache=name)
+        metrics.inc("request_cache_coalesced_total", self.coalesced, cache=name)
+        metrics.set("request_cache_entries", len(self._entries), cache=name)
+
+    async def get(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        self.requests += 1
+
+        if (entry := self._entries.get(key)) is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+            del self._entries[key]
+
+        if (future := self._in_flight.get(key)) is None:
+            future = asyncio.ensure_future(fetch())
+            future.add_done_callback(lambda done: self._store(key, done))
+            self._in_flight[key] = future
+        else:
+            self.coalesced += 1
+
+        # A cancelled caller only cancels the request if nobody else waits on it
+        self._waiters[key] += 1
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if self._waiters[key] == 1:
+                future.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if self._waiters[key] == 0:
+                del self._waiters[key]
+
+    def _store(self, key: str, future: asyncio.Future[Any]) -> None:
+        del self._in_flight[key]
+
+        # Failures aren't cached, the next caller tries again
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        self._entries[key] = (time.monotonic() + self.ttl, future.result())
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
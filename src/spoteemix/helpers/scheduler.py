@@ -0,0 +1,224 @@
+import asyncio
+import threading
+import time
+from collections.abc import (
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Coroutine,
+    Iterable,
+    Iterator,
+)
+from typing import Any
+
+from spoteemix.helpers.metrics import Metrics
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int | None = None) -> None:
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1, int(rate))
+
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class SearchScheduler:
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        rate: float = 0,
+        min_concurrency: int = 1,
+        adaptive: bool = True,
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.adaptive = adaptive
+
+        # Current limit, moves between min and max when adaptive
+        self.limit = max_concurrency
+
+        self.requests = 0
+        self.errors = 0
+        # Seconds calls spent waiting for a slot or the rate limit
+        self.waited = 0.0
+
+        self._bucket = TokenBucket(rate) if rate > 0 else None
+        self._active = 0
+        self._condition = asyncio.Condition()
+
+        self._latency: float | None = None
+        self._min_latency: float | None = None
+        self._increase = 0.0
+        self._last_decrease = 0.0
+
+    async def _acquire(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._active < self.limit)
+            self._active += 1
+
+    async def _release(self) -> None:
+        async with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def _record(self, latency: float, error: bool) -> None:
+        self.requests += 1
+        if error:
+            self.errors += 1
+
+        if not self.adaptive:
+            return
+
+        # Smoothed latency, compared against the best we've seen from this server
+        self._latency = (
+            latency if self._latency is None else 0.8 * self._latency + 0.2 * latency
+        )
+        if self._min_latency is None or self._latency < self._min_latency:
+            self._min_latency = self._latency
+
+        now = time.monotonic()
+        overloaded = error or self._latency > 2 * self._min_latency
+
+        if overloaded:
+            # Back off at most once per round trip, or one burst of failures
+            # would collapse the limit straight down to the minimum
+            if now - self._last_decrease > self._latency:
+                self.limit = max(self.min_concurrency, self.limit // 2)
+                self._increase = 0.0
+                self._last_decrease = now
+        else:
+            # Roughly one extra slot per full window of healthy responses
+            self._increase += 1 / self.limit
+            if self._increase >= 1:
+                self.limit = min(self.max_concurrency, self.limit + 1)
+                self._increase = 0.0
+
+    async def submit(
+        self, func: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any
+    ) -> Any:
+        queued_at = time.monotonic()
+        await self._acquire()
+        try:
+            if self._bucket is not None:
+                await self._bucket.acquire()
+
+            start = time.monotonic()
+            self.waited += start - queued_at
+            try:
+                result = await func(*args, **kwargs)
+            except Exception:
+                self._record(time.monotonic() - start, error=True)
+                raise
+
+            self._record(time.monotonic() - start, error=False)
+            return result
+        finally:
+            await self._release()
+
+    def record(self, metrics: Metrics, name: str) -> None:
+        metrics.inc("scheduler_requests_total", self.requests, scheduler=name)
+        metrics.inc("scheduler_errors_total", self.errors, scheduler=name)
+        metrics.inc("scheduler_wait_seconds_total", self.waited, scheduler=name)
+        metrics.set("scheduler_concurrency_limit", self.limit, scheduler=name)
+
+    async def map(
+        self,
+        func: Callable[[Any], Coroutine[Any, Any, Any]],
+        items: Iterable[Any] | AsyncIterable[Any],
+        window: int | None = None,
+    ) -> AsyncIterator[Any]:
+        # Only a window of coroutines exists at any time, results come in
+        # completion order
+        window = window or self.max_concurrency * 4
+        pending: set[asyncio.Task[Any]] = set()
+
+        if not isinstance(items, AsyncIterable):
+            items = iterate(items)
+
+        try:
+            async for item in items:
+                if len(pending) >= window:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        yield task.result()
+
+                pending.add(asyncio.create_task(func(item)))
+
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+async def iterate(items: Iterable[Any]) -> AsyncIterator[Any]:
+    for item in items:
+        yield item
+
+
+async def iterate_in_thread(
+    items: Iterator[Any], buffer: int = 256
+) -> AsyncIterator[Any]:
+    # Blocking iterators, like a library scan, run in their own thread so the
+    # event loop keeps serving requests while they produce items
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue[tuple[bool, Any]] = asyncio.Queue(buffer)
+    stop = threading.Event()
+
+    def produce() -> None:
+        try:
+            for item in items:
+                if stop.is_set():
+                    # Generators clean up in the thread that ran them
+                    if (close := getattr(items, "close", None)) is not None:
+                        close()
+                    return
+                asyncio.run_coroutine_threadsafe(
+                    queue.put((False, item)), loop
+                ).result()
+        except BaseException as e:
+            asyncio.run_coroutine_threadsafe(queue.put((True, e)), loop).result()
+        else:
+            asyncio.run_coroutine_threadsafe(queue.put((True, None)), loop).result()
+
+    thread = loop.run_in_executor(None, produce)
+
+    try:
+        while True:
+            done, value = await queue.get()
+            if not done:
+                yield value
+            elif value is None:
+                break
+            else:
+                raise value
+    finally:
+        stop.set()
+        # Make room so a producer blocked on a full queue sees the stop
+        while not queue.empty():
+            queue.get_nowait()
+        await thread
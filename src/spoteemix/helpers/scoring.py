@@ -0,0 +1,76 @@
+from array import array
+from collections.abc import Sequence
+from dataclasses import dataclass
+
+from rapidfuzz import fuzz, process, utils
+
+
+class Query:
+    __slots__ = ("title", "artists")
+
+    def __init__(self, title: str, artists: Sequence[str]) -> None:
+        # Artists are normalized once per track, not once per candidate
+        self.title = title
+        self.artists = [utils.default_process(artist) for artist in artists]
+
+
+@dataclass(slots=True)
+class Ranking:
+    # Candidate indexes, best match first, and their confidence
+    order: array[int]
+    confidence: array[float]
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    @property
+    def best(self) -> float:
+        return self.confidence[0] if self.order else 0.0
+
+    def top(self) -> array[int]:
+        # Candidates tied for the highest confidence
+        end = 1
+        while end < len(self.order) and self.confidence[end] == self.confidence[0]:
+            end += 1
+
+        return self.order[:end]
+
+
+def rank_candidates(
+    query: Query, titles: Sequence[str], artists: Sequence[Sequence[str]]
+) -> Ranking:
+    count = len(titles)
+    if count == 0:
+        return Ranking(array("I"), array("d"))
+
+    # One call scores the query title against every candidate title
+    scores = array("d", bytes(8 * count))
+    for _, score, index in process.extract(
+        query.title, titles, scorer=fuzz.ratio, processor=None, limit=None
+    ):
+        scores[index] = score
+
+    if query.artists:
+        # All candidate artists go into one flat column, each is scored by
+        # its best match among the query artists
+        owners = array("I", (i for i, names in enumerate(artists) for _ in names))
+        flat = [utils.default_process(name) for names in artists for name in names]
+        best = array("d", bytes(8 * len(flat)))
+
+        for artist in query.artists:
+            for _, score, index in process.extract(
+                artist, flat, scorer=fuzz.WRatio, processor=None, limit=None
+            ):
+                if score > best[index]:
+                    best[index] = score
+
+        totals = array("d", scores)
+        counts = array("I", [1]) * count
+        for owner, score in zip(owners, best, strict=True):
+            totals[owner] += score
+            counts[owner] += 1
+
+        scores = array("d", (t / c for t, c in zip(totals, counts, strict=True)))
+
+    order = array("I", sorted(range(count), key=lambda i: -scores[i]))
+    return Ranking(order, array("d", (scores[i] for i in order)))
@@ -0,0 +1,450 @@
+import asyncio
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Self
+
+import aiohttp
+import click
+from spotipy.cache_handler import CacheFileHandler
+from spotipy.oauth2 import SpotifyOAuth
+
+from spoteemix.config_helper import APP_NAME
+from spoteemix.helpers.metrics import Metrics
+
+# Overridable so the benchmarks can point us at local stand-ins
+API_URL = os.environ.get("SPOTEEMIX_SPOTIFY_API_URL", "https://api.spotify.com/v1")
+TOKEN_URL = os.environ.get(
+    "SPOTEEMIX_SPOTIFY_TOKEN_URL", "https://accounts.spotify.com/api/token"
+)
+REDIRECT_URI = "http://127.0.0.1:8888"
+
+# Path segments followed by an id, counted under one endpoint
+COLLECTIONS = {"albums", "artists", "playlists", "tracks", "users"}
+
+
+def default_token_path(client_id: str, kind: str) -> Path:
+    return Path(click.get_app_dir(APP_NAME)) / "tokens" / f"{client_id}.{kind}.json"
+
+
+class SpotifyAPIError(click.ClickException):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(f"Spotify API responded with {status}: {message}")
+        self.status = status
+
+
+class TokenProvider(ABC):
+    def __init__(self) -> None:
+        self._token: str | None = None
+        self._expires_at: float = 0.0
+        self._lock = asyncio.Lock()
+
+    def _valid(self) -> bool:
+        # Refresh a minute early so requests in flight don't race the expiry
+        return self._token is not None and time.time() < self._expires_at - 60
+
+    async def token(self, session: aiohttp.ClientSession) -> str:
+        if not self._valid():
+            # Only one refresh at a time, everyone else waits for its result
+            async with self._lock:
+                if not self._valid():
+                    self._token, self._expires_at = await self._fetch(session)
+
+        assert self._token is not None
+        return self._token
+
+    def invalidate(self, token: str) -> None:
+        if self._token == token:
+            self._token = None
+
+    @abstractmethod
+    async def _fetch(self, session: aiohttp.ClientSession) -> tuple[str, float]: ...
+
+
+class ClientCredentials(TokenProvider):
+    def __init__(
+        self, client_id: str, client_secret: str, cache_path: Path | None = None
+    ) -> None:
+        super().__init__()
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.cache_path = cache_path
+
+    def _read_cache(self) -> tuple[str, float] | None:
+        if self.cache_path is None:
+            return None
+
+        try:
+            text = self.cache_path.read_text()
+        except OSError:
+            return None
+
+        # A file cut short by a crash is fetched again
+        try:
+            token_info: dict[str, Any] = json.loads(text)
+        except ValueError:
+            return None
+
+        # Same margin as a token held in memory
+        if time.time() >= token_info["expires_at"] - 60:
+            return None
+
+        return token_info["access_token"], token_info["expires_at"]
+
+    def _write_cache(self, token: str, expires_at: float) -> None:
+        if self.cache_path is None:
+            return
+
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Written whole and readable only by us, it's a credential
+        tmp_path = self.cache_path.with_suffix(".tmp")
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as file:
+            json.dump({"access_token": token, "expires_at": expires_at}, file)
+        os.replace(tmp_path, self.cache_path)
+
+    def invalidate(self, token: str) -> None:
+        super().invalidate(token)
+
+        # A rejected token mustn't be picked up again from the disk
+        cached = self._read_cache()
+        if self.cache_path is not None and cached is not None and cached[0] == token:
+            self.cache_path.unlink(missing_ok=True)
+
+    async def _fetch(self, session: aiohttp.ClientSession) -> tuple[str, float]:
+        # Runs within a token's lifetime reuse it instead of logging in again
+        if (cached := self._read_cache()) is not None:
+            return cached
+
+        async with session.post(
+            TOKEN_URL,
+            data={"grant_type": "client_credentials"},
+            auth=aiohttp.BasicAuth(self.client_id, self.client_secret),
+        ) as resp:
+            if resp.status != 200:
+                raise SpotifyAPIError(resp.status, await resp.text())
+
+            token_info: dict[str, Any] = await resp.json()
+
+        token = token_info["access_token"]
+        expires_at = time.time() + token_info["expires_in"]
+        self._write_cache(token, expires_at)
+
+        return token, expires_at
+
+
+class UserAuthorization(TokenProvider):
+    def __init__(
+        self,
+        client_id: str,
+        client_secret: str,
+        scope: str,
+        cache_path: Path | None = None,
+    ) -> None:
+        super().__init__()
+
+        # Without a path spotipy keeps its token in .cache of the working folder
+        if cache_path is not None:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._cache: Any = CacheFileHandler(
+            cache_path=str(cache_path) if cache_path is not None else None
+        )
+        self._oauth: Any = SpotifyOAuth(
+            scope=scope,
+            client_id=client_id,
+            client_secret=client_secret,
+            redirect_uri=REDIRECT_URI,
+            cache_handler=self._cache,
+        )
+
+    def _authorize(self) -> dict[str, Any]:
+        # Spotipy handles the browser flow, token cache and refresh for us
+        self._oauth.get_access_token(as_dict=False)
+        token_info: dict[str, Any] = self._cache.get_cached_token()
+        return token_info
+
+    def invalidate(self, token: str) -> None:
+        super().invalidate(token)
+
+        # Spotipy would hand out the rejected token again until it expires,
+        # marked expired it's refreshed instead, without a new browser login
+        token_info: dict[str, Any] | None = self._cache.get_cached_token()
+        if token_info is not None and token_info.get("access_token") == token:
+            token_info["expires_at"] = 0
+            self._cache.save_token_to_cache(token_info)
+
+    async def _fetch(self, session: aiohttp.ClientSession) -> tuple[str, float]:
+        token_info = await asyncio.to_thread(self._authorize)
+        return token_info["access_token"], float(token_info["expires_at"])
+
+
+@dataclass
+class RateLimit:
+    # Monotonic time until which Spotify asked us to back off
+    retry_at: float = 0.0
+
+
+def get_id(kind: str, value: str) -> str:
+    if value.startswith(f"spotify:{kind}:"):
+        return value.split(":")[-1]
+
+    return value
+
+
+def params(**kwargs: Any) -> dict[str, str]:
+    return {key: str(value) for key, value in kwargs.items() if value is not None}
+
+
+def endpoint(method: str, url: str) -> str:
+    # Ids are left out, so all requests for one kind of object add up
+    segments = url.removeprefix(f"{API_URL}/").split("/")
+    for i in range(1, len(segments)):
+        if segments[i - 1] in COLLECTIONS:
+            segments[i] = "{id}"
+
+    return f"{method} {'/'.join(segments)}"
+
+
+def retry_reason(status: int) -> str:
+    # Response texts would make a label per message, these are the kinds
+    if status == 0:
+        return "connection error"
+    if status == 429:
+        return "rate limited"
+    if status == 401:
+        return "token rejected"
+    return "server error"
+
+
+class SpotifyAPI:
+    def __init__(
+        self,
+        auth: TokenProvider,
+        max_connections: int = 10,
+        max_retries: int = 5,
+        metrics: Metrics | None = None,
+    ) -> None:
+        self.auth = auth
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+
+        # Requests sent per endpoint and status, retries included
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        self._session: aiohttp.ClientSession | None = None
+        self._owns_session = True
+        self._rate_limit = RateLimit()
+
+    async def __aenter__(self) -> Self:
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.max_connections, keepalive_timeout=30
+            ),
+            timeout=aiohttp.ClientTimeout(total=30),
+        )
+        return self
+
+    async def __aexit__(self, *_: object) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+        self._session = None
+
+    def authorize(self, auth: TokenProvider) -> SpotifyAPI:
+        # Client for another token that shares the connection pool and rate limit
+        api = SpotifyAPI(auth, self.max_connections, self.max_retries, self.metrics)
+        api._session = self._session
+        api._owns_session = False
+        api._rate_limit = self._rate_limit
+        return api
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        query: dict[str, str] | None = None,
+        body: Any = None,
+        retry: bool = True,
+    ) -> Any:
+        if self._session is None:
+            raise RuntimeError("SpotifyAPI used outside of its context")
+
+        url = path if path.startswith("http") else f"{API_URL}/{path}"
+        name = endpoint(method, url)
+        status = 0
+        message = ""
+        retries = 0
+
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                self.metrics.inc(
+                    "spotify_retries_total", endpoint=name, reason=retry_reason(status)
+                )
+                retries = attempt
+
+            if (delay := self._rate_limit.retry_at - time.monotonic()) > 0:
+                self.metrics.inc("spotify_rate_limit_wait_seconds_total", delay)
+                await asyncio.sleep(delay)
+
+            with self.metrics.time("spotify_token_seconds"):
+                token = await self.auth.token(self._session)
+
+            start = time.perf_counter()
+            try:
+                async with self._session.request(
+                    method,
+                    url,
+                    params=query,
+                    json=body,
+                    headers={"Authorization": f"Bearer {token}"},
+                ) as resp:
+                    status = resp.status
+                    self.metrics.inc(
+                        "spotify_requests_total", endpoint=name, status=status
+                    )
+                    self.metrics.observe(
+                        "spotify_request_seconds",
+                        time.perf_counter() - start,
+                        endpoint=name,
+                    )
+
+                    if status == 429:
+                        message = "rate limited"
+                        # Every request waits out the Retry-After, not just this one
+                        retry_after = float(resp.headers.get("Retry-After", 1))
+                        self._rate_limit.retry_at = max(
+                            self._rate_limit.retry_at, time.monotonic() + retry_after
+                        )
+                        continue
+
+                    if status == 401:
+                        message = "access token rejected"
+                        self.auth.invalidate(token)
+                        continue
+
+                    if status >= 500:
+                        message = await resp.text()
+                        # The request may have been applied, ones that aren't
+                        # safe to send twice are left to the caller
+                        if not retry:
+                            break
+                        await asyncio.sleep(min(2**attempt, 30))
+                        continue
+
+                    if status >= 400:
+                        raise SpotifyAPIError(status, await resp.text())
+
+                    if status == 204 or resp.content_length == 0:
+                        return None
+
+                    return await resp.json()
+            except (aiohttp.ClientConnectionError, TimeoutError) as e:
+                status, message = 0, str(e.__class__)
+                self.metrics.inc("spotify_requests_total", endpoint=name, status=status)
+                if not retry:
+                    break
+                await asyncio.sleep(min(2**attempt, 30))
+
+        self.metrics.inc(
+            "errors_total", stage="spotify request", error=retry_reason(status)
+        )
+        raise SpotifyAPIError(status, f"gave up after {retries} retries ({message})")
+
+    async def get(self, path: str, **kwargs: Any) -> Any:
+        return await self.request("GET", path, query=params(**kwargs))
+
+    async def playlist(self, playlist_id: str, fields: str | None = None) -> Any:
+        plid = get_id("playlist", playlist_id)
+        return await self.get(f"playlists/{plid}", fields=fields)
+
+    async def playlist_items(
+        self,
+        playlist_id: str,
+        offset: int = 0,
+        limit: int = 50,
+        fields: str | None = None,
+        additional_types: str = "track",
+    ) -> Any:
+        plid = get_id("playlist", playlist_id)
+        return await self.get(
+            f"playlists/{plid}/items",
+            offset=offset,
+            limit=limit,
+            fields=fields,
+            additional_types=additional_types,
+        )
+
+    async def search(
+        self, q: str, type: str = "track", limit: int = 10, offset: int = 0
+    ) -> Any:
+        return await self.get("search", q=q, type=type, limit=limit, offset=offset)
+
+    async def album(self, album_id: str) -> Any:
+        return await self.get(f"albums/{get_id('album', album_id)}")
+
+    async def albums(self, album_ids: list[str]) -> Any:
+        ids = ",".join(get_id("album", album_id) for album_id in album_ids)
+        return await self.get("albums", ids=ids)
+
+    async def album_tracks(
+        self, album_id: str, offset: int = 0, limit: int = 50
+    ) -> Any:
+        return await self.get(
+            f"albums/{get_id('album', album_id)}/tracks", offset=offset, limit=limit
+        )
+
+    async def current_user_playlists(self, offset: int = 0, limit: int = 50) -> Any:
+        return await self.get("me/playlists", offset=offset, limit=limit)
+
+    async def current_user_playlist_create(
+        self, name: str, public: bool = False, description: str = ""
+    ) -> Any:
+        return await self.request(
+            "POST",
+            "me/playlists",
+            body={"name": name, "public": public, "description": description},
+            retry=False,
+        )
+
+    async def playlist_add_items(
+        self, playlist_id: str, uris: list[str], position: int | None = None
+    ) -> Any:
+        plid = get_id("playlist", playlist_id)
+        body: dict[str, Any] = {"uris": uris}
+        if position is not None:
+            body["position"] = position
+
+        # Sent again by the playlist writer, once it knows they weren't added
+        return await self.request(
+            "POST", f"playlists/{plid}/items", body=body, retry=False
+        )
+
+    async def playlist_replace_items(self, playlist_id: str, uris: list[str]) -> Any:
+        plid = get_id("playlist", playlist_id)
+        return await self.request("PUT", f"playlists/{plid}/items", body={"uris": uris})
+
+    async def playlist_reorder_items(
+        self,
+        playlist_id: str,
+        range_start: int,
+        insert_before: int,
+        range_length: int = 1,
+        snapshot_id: str | None = None,
+    ) -> Any:
+        plid = get_id("playlist", playlist_id)
+        body: dict[str, Any] = {
+            "range_start": range_start,
+            "insert_before": insert_before,
+            "range_length": range_length,
+        }
+        if snapshot_id:
+            body["snapshot_id"] = snapshot_id
+
+        return await self.request("PUT", f"playlists/{plid}/items", body=body)
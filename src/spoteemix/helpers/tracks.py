@@ -0,0 +1,59 @@
+import sys
+from collections.abc import Iterable
+from dataclasses import dataclass
+from typing import Any, Self
+
+# Deezer file sizes that tell which formats a track can be downloaded in
+DEEZER_FORMATS = {
+    "flac": "FILESIZE_FLAC",
+    "mp3_320": "FILESIZE_MP3_320",
+    "mp3_128": "FILESIZE_MP3_128",
+}
+
+
+def intern_artists(artists: Iterable[str]) -> tuple[str, ...]:
+    # The same few artists repeat across a whole library
+    return tuple(sys.intern(artist) for artist in artists)
+
+
+@dataclass(slots=True)
+class SpotifyTrack:
+    id: str | None
+    name: str
+    artists: tuple[str, ...]
+    isrc: str | None
+
+    @classmethod
+    def from_item(cls, item: dict[str, Any]) -> Self:
+        external_ids: dict[str, Any] = item.get("external_ids") or {}
+        return cls(
+            item["id"],
+            item["name"],
+            intern_artists(artist["name"] for artist in item["artists"]),
+            external_ids.get("isrc"),
+        )
+
+
+@dataclass(slots=True)
+class DeezerTrack:
+    sng_id: int
+    title: str
+    artists: tuple[str, ...]
+    formats: tuple[str, ...] = ()
+
+    @classmethod
+    def from_search(cls, found: dict[str, Any]) -> Self:
+        # Only the fields matching and queueing use are kept from the result
+        return cls(
+            int(found["SNG_ID"]),
+            found["SNG_TITLE"],
+            intern_artists(artist["ART_NAME"] for artist in found["ARTISTS"]),
+            tuple(name for name, key in DEEZER_FORMATS.items() if found.get(key)),
+        )
+
+
+@dataclass(slots=True)
+class LocalTrack:
+    title: str
+    artists: tuple[str, ...]
+    path: str
@@ -1,20 +1,29 @@
+import asyncio
 import re
 import shutil
 import sys
 import textwrap
 from collections import Counter
+from contextlib import aclosing
 from dataclasses import dataclass
+from functools import partial
 from typing import Any
 
 import click
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth
 from tqdm import tqdm
+from tqdm.asyncio import tqdm_asyncio
 
-from spoteemix.types.spotify import Album, Playlist, Track
+from spoteemix.helpers.command_helpers import SpotifyClient
+from spoteemix.helpers.pagination import paginate
+from spoteemix.helpers.playlist_writer import write_playlist
+from spoteemix.helpers.spotify_api import SpotifyAPI, SpotifyAPIError
+from spoteemix.types.spotify import Album, Playlist
 
 pl_regex = re.compile(r".*\/playlist\/(\w*)(\?.*)?")
 
+# Most albums one request to the albums endpoint takes
+ALBUMS_PER_REQUEST = 20
+
 
 @dataclass
 class AlbumTableLine:
@@ -34,13 +43,6 @@ class AlbumTableLengths:
     artist: int
 
 
-@dataclass
-class Meta:
-    limit: int
-    offset: int
-    total: int
-
-
 def get_spotify_playlist_id(pl_link: str) -> str:
     if not (pl_match := re.search(pl_regex, pl_link)):
         sys.exit()
@@ -49,31 +51,18 @@ def get_spotify_playlist_id(pl_link: str) -> str:
     return f"spotify:playlist:{pl_id}"
 
 
-def get_spotify_playlist_info(sp: Any, pl_id: str) -> tuple[str, int]:
-    playlist_info: dict[str, Any] = sp.playlist(pl_id, additional_types=[])
+async def get_spotify_playlist_info(sp: SpotifyAPI, pl_id: str) -> tuple[str, int]:
+    playlist_info: dict[str, Any] = await sp.playlist(pl_id, fields="name,items(total)")
 
     name: str = playlist_info["name"]
     total: int = playlist_info["items"]["total"]
     return (name, total)
 
 
-def get_spotify_playlist_items(
-    sp: Any, pl_id: str, offset: int = 0, limit: int = 50
-) -> tuple[list[Track], Meta]:
-    playlist_info: dict[str, Any] = sp.playlist_items(pl_id, limit=limit, offset=offset)
-
-    tracks: list[Track] = playlist_info["items"]
-    meta = Meta(
-        limit=playlist_info["limit"],
-        offset=playlist_info["offset"],
-        total=playlist_info["total"],
-    )
-    return (tracks, meta)
-
-
-def get_album_ids(sp: Any, pl_id: str, total: int | None = None) -> Counter[str]:
-    tracks: list[Track] = []
-    offset: int = 0
+async def get_album_ids(
+    sp: SpotifyAPI, pl_id: str, total: int | None = None
+) -> Counter[str]:
+    albums: Counter[str] = Counter()
 
     # Digits of total track count, for n_fmt padding
     total_digits = str(len(str(total)))
@@ -86,115 +75,111 @@ def get_album_ids(sp: Any, pl_id: str, total: int | None = None) -> Counter[str]
         ascii="⣿⣦⣀",
     )
 
-    while True:
-        left: int | None = total - offset if total else None
-        limit: int = min(left, 50) if left else 50
-
-        new_tracks, meta = get_spotify_playlist_items(
-            sp, pl_id, offset=offset, limit=limit
-        )
-
-        if total != meta.total:
-            total = meta.total
-
-        tracks.extend(new_tracks)
-
-        t.update(meta.limit)
-        offset += meta.limit
-
-        if offset >= meta.total:
-            break
+    # Only the album ids are sent, and counted as the pages arrive
+    async for new_total, items in paginate(
+        partial(sp.playlist_items, pl_id, fields="items(item(album(id))),total"),
+        total=total,
+    ):
+        if t.total != new_total:
+            t.total = new_total
+            t.refresh()
+
+        for item in items:
+            # Unavailable tracks have no item, local files no album id
+            track: dict[str, Any] = item["item"] or {}
+            album: dict[str, Any] = track.get("album") or {}
+            if album_id := album.get("id"):
+                albums[album_id] += 1
+        t.update(len(items))
 
     t.close()
 
-    albums = Counter(track["item"]["album"]["id"] for track in tracks)
     return albums
 
 
-def get_album(sp: Any, album_id: str) -> Album:
-    album: Album = sp.album(album_id)
-    return album
+async def get_albums_from_ids(
+    sp: SpotifyAPI, ids: Counter[str]
+) -> list[tuple[Album, int]]:
+    repeated = [id for id, count in ids.items() if count > 1]
+    chunks = [
+        repeated[i : i + ALBUMS_PER_REQUEST]
+        for i in range(0, len(repeated), ALBUMS_PER_REQUEST)
+    ]
+    batch_supported = True
 
+    async def get_album_batch(ids: list[str]) -> list[Album]:
+        nonlocal batch_supported
 
-def get_albums_from_ids(sp: Any, ids: Counter[str]) -> list[tuple[Album, int]]:
-    albums: list[tuple[Album, int]] = []
+        if batch_supported:
+            try:
+                response: dict[str, Any] = await sp.albums(ids)
+                # Ids the API doesn't know come back as null
+                return [album for album in response["albums"] if album is not None]
+            except SpotifyAPIError as e:
+                if e.status not in (403, 404):
+                    raise
 
-    # Digits of total track count, for n_fmt padding
-    total_digits = str(len(str(len(ids))))
+                # Apps without access to the batch endpoint look albums up one by one
+                batch_supported = False
 
-    for id, count in tqdm(
-        ids.items(),
+        return list(await asyncio.gather(*(sp.album(id) for id in ids)))
+
+    # Digits of total request count, for n_fmt padding
+    total_digits = str(len(str(len(chunks))))
+
+    batches: list[list[Album]] = await tqdm_asyncio.gather(  # type: ignore[reportUnknownMemberType]
+        *(get_album_batch(chunk) for chunk in chunks),
         desc="Looking up albums",
         bar_format="{desc}: {percentage:3.0f}% {bar} {n:"
         + total_digits
         + ".0f}/{total_fmt}",
         ascii="⣿⣦⣀",
-    ):
-        if count > 1:
-            albums.append((get_album(sp, id), count))
+    )
+    albums = [(album, ids[album["id"]]) for albums in batches for album in albums]
 
     return sorted(
         albums, key=lambda x: (x[1], x[0].get("total_tracks", 0)), reverse=True
     )
 
 
-def get_user_playlists(
-    sp_oauth: Any, offset: int = 0, limit: int = 50
-) -> tuple[list[Playlist], Meta]:
-    playlist_info: dict[str, Any] = sp_oauth.current_user_playlists(
-        limit=limit, offset=offset
-    )
-
-    playlists = playlist_info["items"]
-    meta = Meta(
-        limit=playlist_info["limit"],
-        offset=playlist_info["offset"],
-        total=playlist_info["total"],
-    )
-    return (playlists, meta)
-
-
-def find_user_playlist(sp_oauth: Any, pl_name: str) -> str | None:
-    playlists: list[Playlist] = []
-    total: int | None = None
-    offset: int = 0
-
-    while True:
-        left: int | None = total - offset if total else None
-        limit: int = min(left, 50) if left else 50
-
-        new_playlists, meta = get_user_playlists(sp_oauth, offset=offset, limit=limit)
+async def get_album_track_uris(sp: SpotifyAPI, album: Album) -> list[str]:
+    tracks = album["tracks"]
+    uris = [track["uri"] for track in tracks["items"]]
 
-        if total != meta.total:
-            total = meta.total
+    # Only the first page of tracks comes with the album
+    async for _, page in paginate(
+        partial(sp.album_tracks, album["id"]), offset=len(uris), total=tracks["total"]
+    ):
+        uris.extend(track["uri"] for track in page)
 
-        playlists.extend(new_playlists)
+    return uris
 
-        offset += meta.limit
-        if offset >= meta.total:
-            break
 
-    for playlist in playlists:
-        if playlist["name"] == pl_name:
-            return playlist["id"]
+async def find_user_playlist(sp_oauth: SpotifyAPI, pl_name: str) -> str | None:
+    # Closed right away so the pages still in flight are cancelled
+    async with aclosing(paginate(sp_oauth.current_user_playlists)) as pages:
+        async for _, playlists in pages:
+            playlist: Playlist
+            for playlist in playlists:
+                if playlist["name"] == pl_name:
+                    return playlist["id"]
 
     return None
 
 
-def create_playlist(sp_oauth: Any, name: str, description: str) -> str:
-    response = sp_oauth.current_user_playlist_create(
+async def create_playlist(sp_oauth: SpotifyAPI, name: str, description: str) -> str:
+    response = await sp_oauth.current_user_playlist_create(
         name=name, public=False, description=description
     )
     return response["id"]
 
 
-def add_tracks_to_playlist(
-    sp_oauth: Any, pl_id: str, item_uris: list[str], replace: bool = False
+async def add_tracks_to_playlist(
+    sp_oauth: SpotifyAPI, pl_id: str, item_uris: list[str], replace: bool = False
 ) -> None:
-    if replace:
-        sp_oauth.playlist_replace_items(playlist_id=pl_id, items=item_uris)
-    else:
-        sp_oauth.playlist_add_items(playlist_id=pl_id, items=item_uris)
+    # An existing playlist is read first, so a rerun after an interrupted
+    # write only adds what's missing
+    await write_playlist(sp_oauth, pl_id, item_uris, existing=None if replace else [])
 
 
 def print_album_table(lines: list[AlbumTableLine]) -> None:
@@ -300,57 +285,61 @@ def prompt_album_select(albums: list[tuple[Album, int]]):
     return selected_albums
 
 
-def main(client_secret: str, client_id: str, playlist_link: str) -> None:
+async def albums_to_playlist(spotify: SpotifyClient, playlist_link: str) -> None:
     # Used for getting info, no changes being made with this instance
-    sp: Any = spotipy.Spotify(
-        client_credentials_manager=SpotifyClientCredentials(
-            client_id=client_id, client_secret=client_secret
-        )
-    )
-
-    playlist_id = get_spotify_playlist_id(playlist_link)
-    playlist_name, total_tracks = get_spotify_playlist_info(sp, playlist_id)
+    async with spotify.api() as sp:
+        playlist_id = get_spotify_playlist_id(playlist_link)
+        playlist_name, total_tracks = await get_spotify_playlist_info(sp, playlist_id)
 
-    print(f"Found playlist: '{playlist_name}' ({total_tracks} tracks)")
+        print(f"Found playlist: '{playlist_name}' ({total_tracks} tracks)")
 
-    album_ids = get_album_ids(sp, playlist_id, total_tracks)
-    albums = get_albums_from_ids(sp, album_ids)
+        with sp.metrics.stage("spotify playlist"):
+            album_ids = await get_album_ids(sp, playlist_id, total_tracks)
 
-    selected_albums: list[Album] = prompt_album_select(albums)
-    print_album_selection(selected_albums)
+        with sp.metrics.stage("album details"):
+            albums = await get_albums_from_ids(sp, album_ids)
 
-    new_playlist_name = f"Albums from {playlist_name}"
-    new_playlist_description = (
-        f"Most frequent albums from playlist '{playlist_name}'. Generated by spoteemix"
-    )
-    click.confirm(
-        f"Add these into new playlist '{new_playlist_name}'?",
-        default=True,
-        abort=True,
-    )
+        selected_albums: list[Album] = prompt_album_select(albums)
+        print_album_selection(selected_albums)
 
-    track_uris: list[str] = []
-    for album in selected_albums:
-        track_uris.extend([track["uri"] for track in album["tracks"]["items"]])
-
-    # Needed for playlist modifications
-    scope = "playlist-read-private,playlist-modify-private"
-    sp_oauth: Any = spotipy.Spotify(
-        auth_manager=SpotifyOAuth(
-            scope=scope,
-            client_id=client_id,
-            client_secret=client_secret,
-            redirect_uri="http://127.0.0.1:8888",
+        new_playlist_name = f"Albums from {playlist_name}"
+        new_playlist_description = (
+            f"Most frequent albums from playlist '{playlist_name}'."
+            " Generated by spoteemix"
         )
-    )
-
-    replace_tracks = False
-    if pl_id := find_user_playlist(sp_oauth, new_playlist_name):
         click.confirm(
-            "Playlist with that name exist. Overwrite?", default=True, abort=True
+            f"Add these into new playlist '{new_playlist_name}'?",
+            default=True,
+            abort=True,
         )
-        replace_tracks = True
-    else:
-        pl_id = create_playlist(sp_oauth, new_playlist_name, new_playlist_description)
 
-    add_tracks_to_playlist(sp_oauth, pl_id, track_uris, replace=replace_tracks)
+        track_uris: list[str] = []
+        with sp.metrics.stage("album tracks"):
+            for album_uris in await asyncio.gather(
+                *(get_album_track_uris(sp, album) for album in selected_albums)
+            ):
+                track_uris.extend(album_uris)
+
+        # Needed for playlist modifications
+        scope = "playlist-read-private,playlist-modify-private"
+        sp_oauth = spotify.user(sp, scope)
+
+        replace_tracks = False
+        if pl_id := await find_user_playlist(sp_oauth, new_playlist_name):
+            click.confirm(
+                "Playlist with that name exist. Overwrite?", default=True, abort=True
+            )
+            replace_tracks = True
+        else:
+            pl_id = await create_playlist(
+                sp_oauth, new_playlist_name, new_playlist_description
+            )
+
+        with sp.metrics.stage("spotify playlist write"):
+            await add_tracks_to_playlist(
+                sp_oauth, pl_id, track_uris, replace=replace_tracks
+            )
+
+
+def main(spotify: SpotifyClient, playlist_link: str) -> None:
+    asyncio.run(albums_to_playlist(spotify, playlist_link))
@@ -1,13 +1,22 @@
+import asyncio
+import bisect
+import json
+import random
 import re
 import sys
-from random import randint
+from functools import partial
+from pathlib import Path
 from typing import Any
 
 import click
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth
 from tqdm import tqdm
 
+from spoteemix.config_helper import APP_NAME
+from spoteemix.helpers.command_helpers import SpotifyClient
+from spoteemix.helpers.pagination import paginate
+from spoteemix.helpers.playlist_writer import write_playlist
+from spoteemix.helpers.spotify_api import SpotifyAPI
+
 pl_regex = re.compile(r".*\/playlist\/(\w*)(\?.*)?")
 
 
@@ -19,39 +28,173 @@ def get_spotify_playlist_id(pl_link: str) -> str:
     return f"spotify:playlist:{pl_id}"
 
 
-def get_spotify_playlist_info(sp: Any, pl_id: str) -> int:
-    playlist_info: dict[str, Any] = sp.playlist(pl_id)
+def pending_write_path(playlist_id: str) -> Path:
+    pl_id = playlist_id.rsplit(":", 1)[-1]
+    return Path(click.get_app_dir(APP_NAME)) / "shuffles" / f"{pl_id}.json"
+
+
+def read_pending_write(path: Path) -> list[str] | None:
+    try:
+        uris: list[str] = json.loads(path.read_text())
+        return uris
+    except FileNotFoundError:
+        return None
+
+
+async def rewrite_playlist(
+    sp_oauth: SpotifyAPI,
+    playlist_id: str,
+    uris: list[str],
+    existing: list[str] | None = None,
+) -> None:
+    # The playlist is cut to its first hundred tracks before the rest are
+    # added, the target order is kept until they are so it can be resumed
+    path = pending_write_path(playlist_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(uris))
+
+    try:
+        await write_playlist(sp_oauth, playlist_id, uris, existing=existing)
+    except BaseException:
+        click.echo(
+            "Unable to finish writing the playlist,"
+            " run sp-shuffle again to restore its tracks.",
+            err=True,
+        )
+        raise
+
+    path.unlink()
+
+
+async def get_spotify_playlist_info(sp: SpotifyAPI, pl_id: str) -> int:
+    playlist_info: dict[str, Any] = await sp.playlist(
+        pl_id, fields="name,owner(display_name),items(total)"
+    )
     click.secho(f"\nParsing playlist {playlist_info['name']}", fg="blue", nl=False)
     click.echo(" by ", nl=False)
     click.secho(f"{playlist_info['owner']['display_name']}.", fg="magenta")
 
-    return int(playlist_info["tracks"]["total"])
+    return int(playlist_info["items"]["total"])
 
 
-def main(
-    client_secret: str, client_id: str, playlist_link: str, iterations: int
-) -> None:
-    # Used for getting info, no changes being made with this instance
-    sp: Any = spotipy.Spotify(
-        client_credentials_manager=SpotifyClientCredentials(
-            client_id=client_id, client_secret=client_secret
+async def get_playlist_items(
+    sp: SpotifyAPI, pl_id: str, total: int | None = None
+) -> list[dict[str, Any]]:
+    items: list[dict[str, Any]] = []
+
+    async for _, page in paginate(
+        partial(sp.playlist_items, pl_id, fields="items(item(uri,artists(id))),total"),
+        total=total,
+    ):
+        for item in page:
+            # Unavailable items have no uri, but still take up a position
+            track: dict[str, Any] = item["item"] or {}
+            artists: list[dict[str, Any]] = track.get("artists") or [{}]
+            items.append({"uri": track.get("uri"), "artist": artists[0].get("id")})
+
+    return items
+
+
+def spread_artists(order: list[int], artists: list[Any]) -> None:
+    # Best effort, an artist with most of the playlist can't be spread out
+    for i in range(1, len(order)):
+        previous = artists[order[i - 1]]
+        if previous is None or artists[order[i]] != previous:
+            continue
+
+        for j in range(i + 1, len(order)):
+            if artists[order[j]] != previous:
+                order[i], order[j] = order[j], order[i]
+                break
+
+
+def shuffled_order(
+    items: list[dict[str, Any]], seed: int | None, no_repeat_artist: bool
+) -> list[int]:
+    order = list(range(len(items)))
+    random.Random(seed).shuffle(order)
+
+    if no_repeat_artist:
+        spread_artists(order, [item["artist"] for item in items])
+
+    return order
+
+
+def longest_increasing_subsequence(values: list[int]) -> set[int]:
+    # Patience sorting, tails[k] is the index of the smallest value ending
+    # an increasing run of length k + 1
+    tails: list[int] = []
+    tail_values: list[int] = []
+    previous: list[int] = [-1] * len(values)
+
+    for i, value in enumerate(values):
+        k = bisect.bisect_left(tail_values, value)
+        if k > 0:
+            previous[i] = tails[k - 1]
+
+        if k == len(tails):
+            tails.append(i)
+            tail_values.append(value)
+        else:
+            tails[k] = i
+            tail_values[k] = value
+
+    result: set[int] = set()
+    i = tails[-1] if tails else -1
+    while i >= 0:
+        result.add(values[i])
+        i = previous[i]
+
+    return result
+
+
+def reorder_moves(order: list[int]) -> list[tuple[int, int]]:
+    # Tracks on the longest run that's already in the right relative order
+    # stay where they are, every other track is moved once, right after the
+    # track that precedes it in the new order
+    staying = longest_increasing_subsequence(order)
+    current = list(range(len(order)))
+    moves: list[tuple[int, int]] = []
+
+    for k, track in enumerate(order):
+        if track in staying:
+            continue
+
+        range_start = current.index(track)
+        insert_before = current.index(order[k - 1]) + 1 if k > 0 else 0
+        moves.append((range_start, insert_before))
+
+        current.pop(range_start)
+        current.insert(
+            insert_before - 1 if insert_before > range_start else insert_before,
+            track,
         )
-    )
 
-    playlist_id = get_spotify_playlist_id(playlist_link)
-    track_count = get_spotify_playlist_info(sp, playlist_id)
-
-    # Needed for playlist modifications
-    scope = "playlist-modify-private"  # playlist-modify-public doesn't work
-    sp_oauth: Any = spotipy.Spotify(
-        auth_manager=SpotifyOAuth(
-            scope=scope,
-            client_id=client_id,
-            client_secret=client_secret,
-            redirect_uri="http://127.0.0.1:8888",
+    return moves
+
+
+async def reorder_playlist(
+    sp_oauth: SpotifyAPI, playlist_id: str, moves: list[tuple[int, int]]
+) -> None:
+    # Every move depends on the playlist state the previous one left behind
+    snapshot_id = ""
+
+    for range_start, insert_before in tqdm(
+        moves,
+        desc="Moving tracks",
+        bar_format="{desc}: {percentage:3.0f}% {bar} {n:3.0f}/{total_fmt}",
+        ascii="⣿⣦⣀",
+    ):
+        response: dict[str, Any] | None = await sp_oauth.playlist_reorder_items(
+            playlist_id, range_start, insert_before, 1, snapshot_id
         )
-    )
+        if response is not None:
+            snapshot_id = response["snapshot_id"]
+
 
+async def random_moves(
+    sp_oauth: SpotifyAPI, playlist_id: str, track_count: int, iterations: int
+) -> None:
     # Spotify uses this to track the playlist state
     # this program knows of when making changes
     snapshot_id = ""
@@ -65,17 +208,102 @@ def main(
         # This API asks for a range start index, range length and insert index
         # It will move <range_length> tracks starting from index <range_start>
         # And move those tracks before the track on index <insert_before>
-        range_start = randint(0, track_count - 1)
+        range_start = random.randint(0, track_count - 1)
 
         # Using -2 and the following if statement makes it biased towards 1
-        range_length = randint(-2, min(4, track_count - range_start))
+        range_length = random.randint(-2, min(4, track_count - range_start))
         if range_length < 1:
             range_length = 1
 
-        insert_before = randint(0, track_count - range_length + 1)
+        insert_before = random.randint(0, track_count - range_length + 1)
 
-        response: dict[str, Any] | None = sp_oauth.playlist_reorder_items(
+        response: dict[str, Any] | None = await sp_oauth.playlist_reorder_items(
             playlist_id, range_start, insert_before, range_length, snapshot_id
         )
         if response is not None:
             snapshot_id = response["snapshot_id"]
+
+
+async def shuffle_playlist(
+    spotify: SpotifyClient,
+    playlist_link: str,
+    mode: str,
+    iterations: int,
+    seed: int | None,
+    no_repeat_artist: bool,
+    keep_items: bool,
+) -> None:
+    # Used for getting info, no changes being made with this instance
+    async with spotify.api() as sp:
+        playlist_id = get_spotify_playlist_id(playlist_link)
+        track_count = await get_spotify_playlist_info(sp, playlist_id)
+
+        # Needed for playlist modifications
+        scope = "playlist-modify-private"  # playlist-modify-public doesn't work
+        sp_oauth = spotify.user(sp, scope)
+
+        # An interrupted rewrite is finished before the playlist is shuffled again
+        if (pending := read_pending_write(pending_write_path(playlist_id))) is not None:
+            click.echo("Resuming the unfinished shuffle of this playlist.")
+            with sp.metrics.stage("spotify playlist write"):
+                await rewrite_playlist(sp_oauth, playlist_id, pending)
+            click.secho(f"\nRestored {len(pending)} tracks.", fg="green")
+            return
+
+        if mode == "random":
+            with sp.metrics.stage("spotify playlist write"):
+                await random_moves(sp_oauth, playlist_id, track_count, iterations)
+            return
+
+        with sp.metrics.stage("spotify playlist"):
+            items = await get_playlist_items(sp, playlist_id, track_count)
+        order = shuffled_order(items, seed, no_repeat_artist)
+
+        # Local files and unavailable tracks can't be added back by uri
+        if not keep_items and any(
+            item["uri"] is None or item["uri"].startswith("spotify:local:")
+            for item in items
+        ):
+            click.echo("Playlist has local or unavailable tracks, moving them instead.")
+            keep_items = True
+
+        with sp.metrics.stage("spotify playlist write"):
+            if keep_items:
+                # Moving keeps the dates tracks were added, one request per move
+                moves = reorder_moves(order)
+                await reorder_playlist(sp_oauth, playlist_id, moves)
+                requests = len(moves)
+            else:
+                # Rewriting takes one request per hundred tracks
+                await rewrite_playlist(
+                    sp_oauth,
+                    playlist_id,
+                    [items[i]["uri"] for i in order],
+                    existing=[item["uri"] for item in items],
+                )
+                requests = -(-len(order) // 100)
+
+        click.secho(f"\nShuffled {len(order)} tracks", fg="green", nl=False)
+        click.echo(f" with {requests} requests.")
+
+
+def main(
+    spotify: SpotifyClient,
+    playlist_link: str,
+    mode: str,
+    iterations: int,
+    seed: int | None,
+    no_repeat_artist: bool,
+    keep_items: bool,
+) -> None:
+    asyncio.run(
+        shuffle_playlist(
+            spotify,
+            playlist_link,
+            mode,
+            iterations,
+            seed,
+            no_repeat_artist,
+            keep_items,
+        )
+    )